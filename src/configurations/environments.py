@@ -316,7 +316,8 @@ class LargeScaleTerrainConf:
         assert self.hrdem_interpolator_name in [
             "PIL",
             "OpenCV",
-        ], "hrdem_interpolator_name must be either 'PIL' or 'OpenCV'."
+            "CuPy",
+        ], "hrdem_interpolator_name must be either 'PIL', 'OpenCV' or 'CuPy'."
         assert type(self.hrdem_interpolator_padding) == int, "hrdem_interpolator_padding must be an integer."
         assert self.hrdem_interpolator_padding >= 0, "hrdem_interpolator_padding must be a non-negative integer."
 
@@ -354,6 +355,7 @@ class LargeScaleTerrainConf:
             "interpolator_cfg": ICfg,
             "crater_worker_manager_cfg": CWMCfg_D,
             "interpolator_worker_manager_cfg": IWMCfg_D,
+            "interpolator_name": self.hrdem_interpolator_name,
         }
 
         assert type(self.lr_dem_folder_path) == str, "lr_dem_folder_path must be a string."
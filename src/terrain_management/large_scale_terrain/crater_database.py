@@ -6,13 +6,19 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
-from scipy.interpolate import CubicSpline
 from typing import Tuple, List
 import numpy as np
 import dataclasses
 import sys
 
-from src.terrain_management.large_scale_terrain.utils import BoundingBox, CraterMetadata
+from src.terrain_management.large_scale_terrain.utils import (
+    CRATER_METADATA_DTYPE,
+    BoundingBox,
+    CraterMetadata,
+    PiecewiseCubic,
+    QuantizedSpline,
+    craters_to_records,
+)
 
 
 @dataclasses.dataclass
@@ -43,49 +49,50 @@ class CraterDB:
         """
 
         self.crater_db = {}
+        self.crater_records_db = {}
         self.profile_db = {}
         self.crater_db_configs = cfg
 
-    def add_deformation_profiles(self, profiles: List[CubicSpline]) -> None:
+    def add_deformation_profiles(self, profiles: List[QuantizedSpline]) -> None:
         """
         Adds deformation profiles to the database. This is used to cache a
         set of deformation profiles that can be used to generate craters.
 
         Args:
-            profiles (List[CubicSpline]): list of deformation profiles.
+            profiles (List[QuantizedSpline]): list of deformation profiles.
         """
 
         self.profile_db["deformations"] = {}
         for i, profile in enumerate(profiles):
             self.profile_db["deformations"][i] = profile
 
-    def add_marks_profiles(self, profiles: List[CubicSpline]) -> None:
+    def add_marks_profiles(self, profiles: List[QuantizedSpline]) -> None:
         """
         Adds marks profiles to the database. This is used to cache a
         set of marks profiles that can be used to generate craters.
 
         Args:
-            profiles (List[CubicSpline]): list of marks profiles.
+            profiles (List[QuantizedSpline]): list of marks profiles.
         """
 
         self.profile_db["markings"] = {}
         for i, profile in enumerate(profiles):
             self.profile_db["markings"][i] = profile
 
-    def add_crater_profiles(self, profiles: List[CubicSpline]) -> None:
+    def add_crater_profiles(self, profiles: List[PiecewiseCubic]) -> None:
         """
         Adds crater profiles to the database. This is used to cache a
         set of crater profiles that can be used to generate craters.
 
         Args:
-            profiles (List[CubicSpline]): list of crater profiles.
+            profiles (List[PiecewiseCubic]): list of crater profiles.
         """
 
         self.profile_db["craters"] = {}
         for i, profile in enumerate(profiles):
             self.profile_db["craters"][i] = profile
 
-    def get_deformation_spline(self, id: int) -> CubicSpline:
+    def get_deformation_spline(self, id: int) -> QuantizedSpline:
         """
         Gets the deformation spline with the given id.
 
@@ -93,12 +100,12 @@ class CraterDB:
             id (int): id of the spline.
 
         Returns:
-            CubicSpline: deformation spline.
+            QuantizedSpline: deformation spline.
         """
 
         return self.profile_db["deformations"][id]
 
-    def get_marks_spline(self, id: int) -> CubicSpline:
+    def get_marks_spline(self, id: int) -> QuantizedSpline:
         """
         Gets the marks spline with the given id.
 
@@ -106,12 +113,12 @@ class CraterDB:
             id (int): id of the spline.
 
         Returns:
-            CubicSpline: marks spline.
+            QuantizedSpline: marks spline.
         """
 
         return self.profile_db["markings"][id]
 
-    def get_crater_profile_spline(self, id: int) -> CubicSpline:
+    def get_crater_profile_spline(self, id: int) -> PiecewiseCubic:
         """
         Gets the crater profile spline with the given id.
 
@@ -119,19 +126,27 @@ class CraterDB:
             id (int): id of the spline.
 
         Returns:
-            CubicSpline: crater profile spline.
+            PiecewiseCubic: crater profile spline.
         """
 
         return self.profile_db["craters"][id]
 
-    def add_block_data(self, block_data: List[CraterMetadata], block_coordinates: Tuple[float, float]) -> None:
+    def add_block_data(
+        self,
+        block_data: List[CraterMetadata],
+        block_coordinates: Tuple[float, float],
+        block_records: np.ndarray = None,
+    ) -> None:
         """
         Adds a block of data to the database. That is, a list of crater metadata
-        indexed by the block coordinates.
+        indexed by the block coordinates. The crater metadata are also kept packed
+        in a structured array, which is what the crater builder workers are sent.
 
         Args:
             block_data (List[CraterMetadata]): list of crater metadata.
             block_coordinates (Tuple[float, float]): coordinates of the block.
+            block_records (np.ndarray): the crater metadata packed in a structured array.
+                (N,) CRATER_METADATA_DTYPE. If None, they are packed from the block data.
         """
 
         assert (
@@ -142,6 +157,9 @@ class CraterDB:
         ), "Block y-coordinate must be a multiple of the block size."
 
         self.crater_db[block_coordinates] = block_data
+        if block_records is None:
+            block_records = craters_to_records(block_data)
+        self.crater_records_db[block_coordinates] = block_records
 
     def is_valid(self, block_coordinates) -> bool:
         """
@@ -198,6 +216,30 @@ class CraterDB:
                     blocks += self.get_block_data((xc, yc))
         return blocks
 
+    def get_block_records_with_neighbors(self, block_coordinates: Tuple[float, float]) -> np.ndarray:
+        """
+        Gets the crater metadata of the block with the given coordinates and of its
+        neighbors, packed in a structured array. The blocks are concatenated in the
+        same order as in get_block_data_with_neighbors.
+
+        Args:
+            block_coordinates (Tuple[float, float]): coordinates of the block.
+
+        Returns:
+            np.ndarray: the crater metadata. (N,) CRATER_METADATA_DTYPE.
+        """
+
+        blocks = []
+        for x in range(-1, 2, 1):
+            xc = block_coordinates[0] + x * self.crater_db_configs.block_size
+            for y in range(-1, 2, 1):
+                yc = block_coordinates[1] + y * self.crater_db_configs.block_size
+                if self.check_block_exists((xc, yc)):
+                    blocks.append(self.crater_records_db[(xc, yc)])
+        if not blocks:
+            return np.empty(0, dtype=CRATER_METADATA_DTYPE)
+        return np.concatenate(blocks)
+
     def check_block_exists(self, block_coordinates: Tuple[float, float]) -> bool:
         """
         Checks if the block with the given coordinates exists in the database.
@@ -6,7 +6,6 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
-from scipy.interpolate import CubicSpline
 from matplotlib import pyplot as plt
 from typing import List, Tuple
 import dataclasses
@@ -14,7 +13,15 @@ import numpy as np
 import colorsys
 import pickle
 
-from src.terrain_management.large_scale_terrain.utils import BoundingBox, CraterMetadata
+from src.terrain_management.large_scale_terrain.utils import (
+    BoundingBox,
+    CraterMetadata,
+    PiecewiseCubic,
+    QuantizedSpline,
+    build_cubic_prefilter_batch,
+    craters_to_records,
+    quantize_profiles,
+)
 from src.terrain_management.large_scale_terrain.crater_database import CraterDB
 
 
@@ -349,32 +356,32 @@ class CraterMetadataGenerator:
         self.generate_marking_profiles()
         self.load_profiles()
 
-    def get_crater_profiles(self) -> List[CubicSpline]:
+    def get_crater_profiles(self) -> List[PiecewiseCubic]:
         """
         Gets the half crater profiles. This is used by the database to store the profiles.
 
         Returns:
-            List[CubicSpline]: list of half crater profiles.
+            List[PiecewiseCubic]: list of half crater profiles.
         """
 
         return self.crater_profiles
 
-    def get_deformation_profiles(self) -> List[CubicSpline]:
+    def get_deformation_profiles(self) -> List[QuantizedSpline]:
         """
         Gets the deformation profiles. This is used by the database to store the profiles.
 
         Returns:
-            List[CubicSpline]: list of deformation profiles.
+            List[QuantizedSpline]: list of deformation profiles.
         """
 
         return self.deformation_profiles
 
-    def get_marking_profiles(self) -> List[CubicSpline]:
+    def get_marking_profiles(self) -> List[QuantizedSpline]:
         """
         Gets the marking profiles. This is used by the database to store the profiles.
 
         Returns:
-            List[CubicSpline]: list of marking profiles.
+            List[QuantizedSpline]: list of marking profiles.
         """
 
         return self.marking_profiles
@@ -382,36 +389,55 @@ class CraterMetadataGenerator:
     def generate_deformation_profiles(self) -> None:
         """
         Generates the deformation profiles for the craters.
+        All the profiles are sampled at once, and their spline coefficients are computed
+        in a single batch.
         """
 
         print("Pre-generating crater deformation profiles")
-        for i in range(self.settings.num_unique_profiles):
-            deformation_profile = self._rng.uniform(0.95, 1, 9)
-            deformation_profile = np.concatenate([deformation_profile, [deformation_profile[0]]], axis=0)
-            tmp_x = np.linspace(0, 1, deformation_profile.shape[0])
-            self.deformation_profiles.append(CubicSpline(tmp_x, deformation_profile, bc_type=((1, 0.0), (1, 0.0))))
+        deformation_profiles = self._rng.uniform(0.95, 1, (self.settings.num_unique_profiles, 9))
+        deformation_profiles = np.concatenate([deformation_profiles, deformation_profiles[:, :1]], axis=1)
+        self.deformation_profiles = self.make_splines(deformation_profiles)
 
     def generate_marking_profiles(self) -> None:
         """
         Generates the marking profiles for the craters.
+        All the profiles are sampled at once, and their spline coefficients are computed
+        in a single batch.
         """
 
         print("Pre-generating crater marking profiles")
-        for i in range(self.settings.num_unique_profiles):
-            # Generates a profile to add marks that converges toward the center of the crater
-            marks_profile = self._rng.uniform(0.0, 0.01, 45)
-            marks_profile = np.concatenate([marks_profile, [marks_profile[0]]], axis=0)
-            tmp_x = np.linspace(0, 1, marks_profile.shape[0])
-            self.marking_profiles.append(CubicSpline(tmp_x, marks_profile, bc_type=((1, 0.0), (1, 0.0))))
+        # Generates profiles to add marks that converge toward the center of the crater
+        marks_profiles = self._rng.uniform(0.0, 0.01, (self.settings.num_unique_profiles, 45))
+        marks_profiles = np.concatenate([marks_profiles, marks_profiles[:, :1]], axis=1)
+        self.marking_profiles = self.make_splines(marks_profiles)
+
+    @staticmethod
+    def make_splines(profiles: np.ndarray) -> List[QuantizedSpline]:
+        """
+        Builds the splines interpolating a batch of profiles sampled uniformly over [0, 1].
+        The splines have a zero slope at both ends. Their coefficients are quantized to
+        16 bits, which halves the memory they use.
+
+        Args:
+            profiles (np.ndarray): samples of the profiles, one profile per row.
+
+        Returns:
+            List[QuantizedSpline]: list of splines.
+        """
+
+        coeffs, scales = quantize_profiles(build_cubic_prefilter_batch(profiles))
+        dx = 1.0 / (profiles.shape[1] - 1)
+        return [QuantizedSpline(coeffs=c, scale=float(s), x0=0.0, dx=dx) for c, s in zip(coeffs, scales)]
 
     def load_profiles(self) -> None:
         """
-        Loads the half crater spline profiles from a pickle file.
+        Loads the half crater spline profiles from a pickle file. Only the coefficients
+        of the splines are kept.
         """
 
         print("Loading crater profiles")
         with open(self.settings.profiles_path, "rb") as handle:
-            self.crater_profiles = pickle.load(handle)
+            self.crater_profiles = [PiecewiseCubic.from_cubic_spline(spline) for spline in pickle.load(handle)]
 
     def randomize_crater_parameters(self, coordinates: Tuple[float, float], radius: float) -> CraterMetadata:
         """
@@ -607,7 +633,8 @@ class CraterSampler:
             )
             coord, rad = self.crater_dist_gen.run(bb, prev_coords=prev_coords)
             block = self.crater_metadata_gen.run(coord, rad)
-            self.crater_db.add_block_data(block, block_coordinates)
+            # The metadata are packed once, here, and reused each time the block is sent to the workers.
+            self.crater_db.add_block_data(block, block_coordinates, craters_to_records(block))
 
     def dissect_region_blocks(
         self, blocks: Tuple[np.ndarray, np.ndarray], region: BoundingBox
@@ -687,7 +714,7 @@ class CraterSampler:
             new_blocks_list, block_coordinates_list = self.dissect_region_blocks(new_blocks, region)
             for (coordinates, radius), block_coordinates in zip(new_blocks_list, block_coordinates_list):
                 metadata = self.crater_metadata_gen.run(coordinates, radius)
-                self.crater_db.add_block_data(metadata, block_coordinates)
+                self.crater_db.add_block_data(metadata, block_coordinates, craters_to_records(metadata))
 
         # If the largest rectangle is smaller or equal to 1 block, we sample craters
         # on a per block basis.
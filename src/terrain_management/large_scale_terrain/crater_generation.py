@@ -6,16 +6,24 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
-from scipy.ndimage import rotate
-from typing import Tuple, List
+from typing import Tuple, List, Union
 import numpy as np
+import math
 import dataclasses
 
 from src.terrain_management.large_scale_terrain.crater_database import (
     CraterDB,
     CraterDBConf,
 )
-from src.terrain_management.large_scale_terrain.utils import CraterMetadata, BoundingBox
+from src.terrain_management.large_scale_terrain.utils import (
+    CraterMetadata,
+    BoundingBox,
+    craters_to_records,
+    eval_cubic,
+    eval_piecewise_cubic,
+    make_bicubic_wlut,
+    rotate_cubic,
+)
 
 
 @dataclasses.dataclass
@@ -40,15 +48,20 @@ class CraterBuilder:
     It can be added to a DEM to create a more realistic terrain.
     """
 
-    def __init__(self, settings: CraterBuilderConf, db: CraterDB) -> None:
+    def __init__(self, settings: CraterBuilderConf, db: CraterDB, wlut: np.ndarray = None) -> None:
         """
         Args:
             settings (CraterBuilderConf): configuration for the crater builder.
             db (CraterDB): database containing the craters data.
+            wlut (np.ndarray): lookup table of the spline weights, see make_bicubic_wlut.
+                If None, a new one is computed.
         """
 
         self.settings = settings
         self.db = db
+        if wlut is None:
+            wlut = make_bicubic_wlut()
+        self._wlut = wlut
 
     @staticmethod
     def sat_gaussian(x: np.ndarray, mu1: float, mu2: float, std: float) -> np.ndarray:
@@ -71,13 +84,15 @@ class CraterBuilder:
         x[x < mu1] = np.exp(-0.5 * ((x[x < mu1] - mu1) / std) ** 2)
         x[x > mu2] = np.exp(-0.5 * ((x[x > mu2] - mu2) / std) ** 2)
         x[(x >= mu1) & (x <= mu2)] = 1.0
-        x = x / (std * np.sqrt(2 * np.pi))
+        # The scale is a Python float, such that the type of x is kept.
+        x = x / (std * math.sqrt(2 * math.pi))
         x = x.reshape(shape)
         return x
 
     def centered_distance_matrix(self, crater_metadata: CraterMetadata) -> np.ndarray:
         """
         Generates a distance matrix centered at the center of the matrix.
+        The matrix is computed in float32, like the rest of the DEM pipeline.
 
         Args:
             crater_metadata (CraterMetadata): data used to generate the crater.
@@ -93,16 +108,27 @@ class CraterBuilder:
         marks_spline = self.db.get_marks_spline(crater_metadata.marks_spline_id)
 
         # Generates the deformation matrix
-        m = np.zeros([size, size])
-        x, y = np.meshgrid(np.linspace(-1, 1, size), np.linspace(-1, 1, size))
-        theta = np.arctan2(y, x)
-        fac = deformation_spline(theta / (2 * np.pi) + 0.5)
+        x, y = np.meshgrid(np.linspace(-1, 1, size, dtype=np.float32), np.linspace(-1, 1, size, dtype=np.float32))
+        theta = np.arctan2(y, x) / (2 * np.pi) + 0.5
+        fac = eval_cubic(
+            deformation_spline.coeffs,
+            deformation_spline.scale,
+            deformation_spline.x0,
+            deformation_spline.dx,
+            theta,
+            self._wlut,
+        )
 
         # Generates the marks matrix
-        marks = marks_spline(theta / (2 * np.pi) + 0.5) * size / 2 * crater_metadata.marks_intensity
+        marks = (
+            eval_cubic(marks_spline.coeffs, marks_spline.scale, marks_spline.x0, marks_spline.dx, theta, self._wlut)
+            * size
+            / 2
+            * crater_metadata.marks_intensity
+        )
 
         # Generates the distance matrix
-        x, y = np.meshgrid(range(size), range(size))
+        x, y = np.meshgrid(np.arange(size, dtype=np.float32), np.arange(size, dtype=np.float32))
         m = np.sqrt(((x - (size / 2) + 1) / crater_metadata.xy_deformation_factor[0]) ** 2 + (y - (size / 2) + 1) ** 2)
 
         # Deforms the distance matrix
@@ -121,7 +147,7 @@ class CraterBuilder:
         m = m + marks * sat
 
         # Rotate the matrix
-        m = rotate(m, crater_metadata.rotation, reshape=False, cval=size / 2)
+        m = rotate_cubic(m, float(crater_metadata.rotation), size / 2, self._wlut)
 
         # Saturate the matrix such that the distance is not greater than the radius of the crater
         m[m > size / 2] = size / 2
@@ -141,7 +167,7 @@ class CraterBuilder:
         """
 
         profile_spline = self.db.get_crater_profile_spline(crater_metadata.crater_profile_id)
-        crater = profile_spline(2 * distance / size)
+        crater = eval_piecewise_cubic(profile_spline.coeffs, profile_spline.breaks, 2 * distance / size)
         return crater
 
     def generate_crater(self, crater_metadata: CraterMetadata) -> np.ndarray:
@@ -166,53 +192,50 @@ class CraterBuilder:
         )
         return crater
 
-    def check_if_crater_is_in_block(
-        self, crater_metadata: CraterMetadata, coords_np: np.ndarray, pad_size: int, dem_size: int
-    ) -> bool:
-        is_in_block = True
-        coord = np.array(crater_metadata.coordinates - coords_np) / self.settings.resolution
-        c_size = int(crater_metadata.radius * 2 / self.settings.resolution)
-
-        c_size += c_size % 2
-        coord_padded = (coord + pad_size).astype(np.int64)
-        if ((coord_padded[0] - c_size / 2) < 0) or ((coord_padded[1] - c_size / 2) < 0):
-            is_in_block = False
-        elif ((coord_padded[0] + c_size / 2) >= (pad_size * 2 + dem_size)) or (
-            (coord_padded[1] + c_size / 2) >= (pad_size * 2 + dem_size)
-        ):
-            is_in_block = False
-        return is_in_block, coord_padded
-
     def generate_craters(
         self,
-        craters_data: List[CraterMetadata],
+        craters_data: Union[List[CraterMetadata], np.ndarray],
         coords: Tuple[int, int],
     ) -> np.ndarray:
         """
-        Generates a DEM with craters.
+        Generates a DEM with craters. The craters that do not fit in the padded block
+        are discarded all at once, before any crater is generated.
 
         Args:
-            craters_data (List[CraterMetadata]): list of craters metadata.
+            craters_data (Union[List[CraterMetadata], np.ndarray]): list of craters metadata,
+                or structured array of craters metadata with the CRATER_METADATA_DTYPE dtype.
             coords (Tuple[int, int]): coordinates of the block.
 
         Returns:
             np.ndarray: DEM with craters.
         """
 
-        # Creates a padded DEM and mask
+        if not isinstance(craters_data, np.ndarray):
+            craters_data = craters_to_records(craters_data)
+
+        # Creates a padded DEM and mask. The DEM is stored in float32, the type used by
+        # the high resolution DEM, such that it does not need to be converted afterwards.
         dem_size = int(self.settings.block_size / self.settings.resolution)
         pad_size = int(self.settings.pad_size / self.settings.resolution)
-        DEM_padded = np.zeros((pad_size * 2 + dem_size, pad_size * 2 + dem_size))
+        DEM_padded = np.zeros((pad_size * 2 + dem_size, pad_size * 2 + dem_size), dtype=np.float32)
         coords_np = np.array(coords)
-        # Adds the craters to the DEM
-        for crater_data in craters_data:
-            is_in_block, coord_padded = self.check_if_crater_is_in_block(crater_data, coords_np, pad_size, dem_size)
-            if not is_in_block:
-                continue
 
-            c = self.generate_crater(crater_data)
+        # A crater is kept if it fits entirely in the padded DEM. All the craters are tested at once.
+        coord = (craters_data["coordinates"] - coords_np) / self.settings.resolution
+        coord_padded = (coord + pad_size).astype(np.int64)
+        # The size is computed in float64, like generate_crater does.
+        c_size = (craters_data["radius"].astype(np.float64) * 2 / self.settings.resolution).astype(np.int64)
+        c_size += c_size % 2
+        half_size = (c_size / 2)[:, None]
+        is_in_block = np.all(
+            ((coord_padded - half_size) >= 0) & ((coord_padded + half_size) < (pad_size * 2 + dem_size)), axis=1
+        )
+
+        # Adds the craters to the DEM
+        for i in np.flatnonzero(is_in_block):
+            c = self.generate_crater(CraterMetadata(*craters_data[i].tolist()))
             size = c.shape[0]
-            coord_offset = (coord_padded - size / 2).astype(np.int64)
+            coord_offset = (coord_padded[i] - size / 2).astype(np.int64)
             DEM_padded[
                 coord_offset[0] : coord_offset[0] + size,
                 coord_offset[1] : coord_offset[1] + size,
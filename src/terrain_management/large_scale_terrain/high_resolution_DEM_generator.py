@@ -9,12 +9,21 @@ __status__ = "development"
 from typing import List, Tuple, Dict
 import numpy as np
 import dataclasses
+import multiprocessing
+import importlib.util
 import threading
+import math
+import logging
 import warnings
 import time
-import copy
 
-from src.terrain_management.large_scale_terrain.utils import ScopedTimer, BoundingBox, CraterMetadata
+from src.terrain_management.large_scale_terrain.utils import (
+    ScopedTimer,
+    BoundingBox,
+    CraterMetadata,
+    make_bicubic_wlut,
+    minmax,
+)
 from src.terrain_management.large_scale_terrain.crater_generation import (
     CraterBuilder,
     CraterDB,
@@ -30,9 +39,22 @@ from src.terrain_management.large_scale_terrain.high_resolution_DEM_workers impo
     BicubicInterpolatorManager,
     WorkerManagerConf,
     InterpolatorConf,
+    Interpolator,
     CPUInterpolator_PIL,
+    CPUInterpolator,
+    GPUInterpolator,
     ThreadMonitor,
 )
+from src.terrain_management.large_scale_terrain.high_resolution_DEM_numba import (
+    _deposit,
+    _zero_fill,
+    _shift_2d,
+    set_threading_layer_priority,
+    warmup_kernels,
+    warmup_worker_kernels,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @dataclasses.dataclass
@@ -81,6 +103,7 @@ class HighResDEMGenConf:
         interpolator_cfg (InterpolatorConf): The configuration for the interpolator.
         crater_worker_manager_cfg (WorkerManagerConf): The configuration for the crater worker manager.
         interpolator_worker_manager_cfg (WorkerManagerConf): The configuration for the interpolator worker manager.
+        interpolator_name (str): The interpolator to use. Can be one of "PIL", "OpenCV" or "CuPy".
     """
 
     high_res_dem_cfg: HighResDEMConf = dataclasses.field(default_factory=dict)
@@ -90,6 +113,7 @@ class HighResDEMGenConf:
     interpolator_cfg: InterpolatorConf = dataclasses.field(default_factory=dict)
     crater_worker_manager_cfg: WorkerManagerConf = dataclasses.field(default_factory=dict)
     interpolator_worker_manager_cfg: WorkerManagerConf = dataclasses.field(default_factory=dict)
+    interpolator_name: str = "PIL"
 
     def __post_init__(self):
         self.high_res_dem_cfg = HighResDEMConf(**self.high_res_dem_cfg)
@@ -114,7 +138,8 @@ class HighResDEMGen:
     ) -> None:
         """
         Args:
-            low_res_dem (np.ndarray): The low resolution DEM.
+            low_res_dem (np.ndarray): The low resolution DEM. It can be memory mapped, only the
+                patches needed to generate the blocks are read from it.
             settings (HighResDEMGenConf): The settings for the high resolution DEM generation.
             profiling (bool): True if the profiling is enabled, False otherwise.
         """
@@ -136,6 +161,9 @@ class HighResDEMGen:
         Builds the objects responsible to generate the high resolution DEM.
         """
 
+        # Must happen before the first parallel kernel runs, the crater sampler already runs one.
+        set_threading_layer_priority()
+
         # Creates the crater DB and crater sampler
         # The DB is used to store the crater metadata and the sampler is used
         # to generate the craters metadata.
@@ -144,29 +172,71 @@ class HighResDEMGen:
         # Creates the crater builder and the interpolator they are used by the
         # worker managers to distribute the generation of craters and the
         # interpolation of the terrain data accross multiple workers.
-        self.crater_builder = CraterBuilder(self.settings.crater_builder_cfg, db=self.crater_db)
-        self.interpolator = CPUInterpolator_PIL(self.settings.interpolator_cfg)
+        # The weights of the splines used to warp the crater profiles are precomputed once.
+        self._wlut = make_bicubic_wlut()
+        self.crater_builder = CraterBuilder(self.settings.crater_builder_cfg, db=self.crater_db, wlut=self._wlut)
+        self.interpolator = self.get_interpolator()
         # Creates the worker managers that will distribute the work to the workers.
         # This enables the generation of craters and the interpolation of the terrain
         # data to be done in parallel.
         self.monitor_thread = ThreadMonitor()
+        # Compiles the serial kernels of the workers before they are forked, such that
+        # they inherit them and their first job does not have to compile them.
+        warmup_worker_kernels()
+        # Both managers share the event their workers set when they output a result.
+        # It is created from a spawn context, such that it can also be given to spawned workers.
+        self.progress_event = multiprocessing.get_context("spawn").Event()
 
         self.crater_builder_manager = CraterBuilderManager(
             settings=self.settings.crater_worker_manager_cfg,
             builder=self.crater_builder,
             parent_thread=self.monitor_thread.thread,
+            progress_event=self.progress_event,
+        )
+        # Size of the low resolution patches sent to the interpolator, padding included.
+        source_size = (
+            int(self.settings.high_res_dem_cfg.block_size / self.settings.high_res_dem_cfg.source_resolution)
+            + 2 * self.settings.high_res_dem_cfg.interpolation_padding
         )
         self.interpolator_manager = BicubicInterpolatorManager(
             settings=self.settings.interpolator_worker_manager_cfg,
             interp=self.interpolator,
+            source_shape=(source_size, source_size),
             parent_thread=self.monitor_thread.thread,
+            progress_event=self.progress_event,
         )
+        # Compiles the parallel kernels, such that the first update does not have to compile them.
+        # This must happen after the workers are forked: compiling a parallel kernel starts
+        # Numba's thread pool, and forking a process that runs a TBB pool hangs it on exit.
+        warmup_kernels()
         # Instantiates the high resolution DEM with the given settings.
         self.settings = self.settings.high_res_dem_cfg
         self.build_block_grid()
         self.instantiate_high_res_dem()
         self.get_low_res_dem_offset()
 
+    def get_interpolator(self) -> Interpolator:
+        """
+        Instantiates the interpolator matching the interpolator name in the settings.
+        If CuPy is requested but not installed, the PIL interpolator is used instead.
+
+        Returns:
+            Interpolator: The interpolator used by the interpolation workers.
+        """
+
+        name = self.settings.interpolator_name
+        if (name == "CuPy") and (importlib.util.find_spec("cupy") is None):
+            warnings.warn("CuPy is not installed, falling back to the PIL interpolator.")
+            name = "PIL"
+        if name == "CuPy":
+            return GPUInterpolator(self.settings.interpolator_cfg)
+        elif name == "OpenCV":
+            return CPUInterpolator(self.settings.interpolator_cfg)
+        elif name == "PIL":
+            return CPUInterpolator_PIL(self.settings.interpolator_cfg)
+        else:
+            raise ValueError(f"Invalid interpolator name: {name}")
+
     def get_current_block_coordinates(self) -> Tuple[float, float]:
         """
         Returns the current block coordinates.
@@ -185,6 +255,26 @@ class HighResDEMGen:
         self.lr_dem_ratio = self.settings.source_resolution / self.settings.resolution
         self.lr_dem_block_size = int(self.settings.block_size / self.settings.source_resolution)
 
+        # Block aligned view on all the patches of the low resolution DEM, padding included.
+        # The patches are not copied, the view only changes the strides of the DEM.
+        pad = self.settings.interpolation_padding
+        patch_size = self.lr_dem_block_size + 2 * pad
+        self.lr_dem_patches = None
+        self.lr_dem_patches_start = (0, 0)
+        if (
+            (self.lr_dem_block_size > 0)
+            and (self.low_res_dem.shape[0] >= patch_size)
+            and (self.low_res_dem.shape[1] >= patch_size)
+        ):
+            self.lr_dem_patches_start = (
+                (self.lr_dem_px_offset[0] - pad) % self.lr_dem_block_size,
+                (self.lr_dem_px_offset[1] - pad) % self.lr_dem_block_size,
+            )
+            self.lr_dem_patches = np.lib.stride_tricks.sliding_window_view(self.low_res_dem, (patch_size, patch_size))[
+                self.lr_dem_patches_start[0] :: self.lr_dem_block_size,
+                self.lr_dem_patches_start[1] :: self.lr_dem_block_size,
+            ]
+
     def instantiate_high_res_dem(self) -> None:
         """
         Instantiates the high resolution DEM with the given settings.
@@ -194,16 +284,26 @@ class HighResDEMGen:
         buffer of blocks to reuse when the high resolution DEM is shifted.
 
         Please note that this function does not generate the actual DEM, but only instantiates
-        an empty numpy array with the correct dimensions.
+        an empty numpy array with the correct dimensions. The array is zeroed in parallel.
+
+        The DEM comes with a revision counter that is incremented each time its content
+        changes, and with the minimum and maximum of the blocks holding data. While no
+        block holds data, the minimum is +inf and the maximum is -inf. They let consumers,
+        like a viewer, skip redraws and renormalizations when nothing changed.
         """
 
-        self.high_res_dem = np.zeros(
+        self.high_res_dem = np.empty(
             (
                 int((self.settings.num_blocks * 2 + 3) * self.settings.block_size / self.settings.resolution),
                 int((self.settings.num_blocks * 2 + 3) * self.settings.block_size / self.settings.resolution),
             ),
             dtype=np.float32,
         )
+        _zero_fill(self.high_res_dem)
+        self.dirty_revision = 0
+        self.dem_min = math.inf
+        self.dem_max = -math.inf
+        self.dem_range_is_stale = False
 
     def cast_coordinates_to_block_space(self, coordinates: Tuple[float, float]) -> Tuple[int, int]:
         """
@@ -212,7 +312,8 @@ class HighResDEMGen:
         the resolution of the high resolution DEM.
 
         The coordinates are still expressed in meters, but they can only be an increment of
-        the block size (in meters).
+        the block size (in meters). When the block size is a power of two, the cast is a
+        bitmask on the floored coordinates.
 
         Args:
             coordinates (Tuple[float, float]): Coordinates in meters.
@@ -222,23 +323,29 @@ class HighResDEMGen:
         """
 
         x, y = coordinates
+        if self.block_mask is not None:
+            return (math.floor(x) & self.block_mask, math.floor(y) & self.block_mask)
         x_block = int(x // self.settings.block_size) * self.settings.block_size
         y_block = int(y // self.settings.block_size) * self.settings.block_size
         return (x_block, y_block)
 
     def build_block_grid(self) -> None:
         """
-        The block grid is a dictionary that keeps track of the state of each block in the
-        grid. The state of each block is represented by a dictionary with the following
-        keys:
+        The block grid keeps track of the state of each block in the grid. The state is
+        stored as a dictionary of boolean arrays of shape (G, G), with G = 2 * num_blocks + 3.
+        Each array is indexed by the grid indices (ix, iy) of the blocks and holds one flag:
             - has_crater_metadata: True if the block has the crater metadata, False otherwise.
             - has_crater_data: True if the block has the crater data, False otherwise.
             - has_terrain_data: True if the block has the terrain data, False otherwise.
             - is_padding: True if the block is a padding block, False otherwise.
 
-        The map_grid_block2coords is a dictionary that maps the block coordinates to the
-        grid coordinates. This is useful to quickly find the block in the grid given the
-        grid coordinates.
+        The grid indices of a block are obtained from its coordinates using the
+        get_grid_index function. The block coordinates of a grid cell are obtained using
+        the get_block_coordinates function.
+
+        The block_px_offsets is an array that maps the grid indices to the pixel
+        coordinates of the top left corner of the block in the high resolution DEM. Since
+        the grid indices do not change when the grid is shifted, it is only computed once.
 
         The block grid is generated with a padding of 1 block in each direction. This is
         done to avoid edge cases when computing the terrain data and to have a buffer of
@@ -250,37 +357,98 @@ class HighResDEMGen:
         # that waits for one reconstruction to finish before starting the next one. The state could be
         # augmented to have a flag that says a given block is already being processed.
 
-        self.block_grid_tracker = {}
-        self.map_grid_block2coords = {}
+        self.grid_size = 2 * self.settings.num_blocks + 3
+        # If the block size is a power of two, coordinates are cast to the block space with a bitmask.
+        block_size = self.settings.block_size
+        self.block_mask = None
+        if (block_size == int(block_size)) and (block_size > 0) and ((int(block_size) & (int(block_size) - 1)) == 0):
+            self.block_mask = ~(int(block_size) - 1)
+        self.block_px = int(self.settings.block_size / self.settings.resolution)
+        # Offset to account for the padding blocks
+        offset = int((self.settings.num_blocks + 1) * self.settings.block_size / self.settings.resolution)
 
-        # Instantiate empty state for each block in the grid
-        state = {
+        # Allocate the state of the blocks in the grid, it is only allocated once and reset in place.
+        shape = (self.grid_size, self.grid_size)
+        self.block_grid_tracker = {
+            "has_crater_metadata": np.empty(shape, dtype=np.bool_),
+            "has_crater_data": np.empty(shape, dtype=np.bool_),
+            "has_terrain_data": np.empty(shape, dtype=np.bool_),
+            "is_padding": np.ones(shape, dtype=np.bool_),
+        }
+        # The padding blocks are the outer ring of the grid
+        self.block_grid_tracker["is_padding"][1:-1, 1:-1] = False
+        self.reset_block_grid()
+
+        # Pixel offsets of each block of the grid
+        block_c = (np.arange(self.grid_size) - self.settings.num_blocks - 1) * self.settings.block_size
+        block_px = np.trunc(block_c / self.settings.resolution).astype(np.int64) + offset
+        self.block_px_offsets = np.empty((self.grid_size, self.grid_size, 2), dtype=np.int64)
+        self.block_px_offsets[:, :, 0] = block_px[:, None]
+        self.block_px_offsets[:, :, 1] = block_px[None, :]
+
+    def get_block_reset_values(self) -> Dict[str, bool]:
+        """
+        Returns the state of a block that has not been processed yet.
+
+        Returns:
+            Dict[str, bool]: Value of each flag of the block grid tracker, padding excluded.
+        """
+
+        return {
             "has_crater_metadata": not self.settings.generate_craters,
             "has_crater_data": not self.settings.generate_craters,
             "has_terrain_data": False,
-            "is_padding": False,
         }
-        # Generate a grid that spans num_blocks in each direction plus 1 block for caching
-        for x in range(-self.settings.num_blocks - 1, self.settings.num_blocks + 2, 1):
-            x_c = x * self.settings.block_size
-            x_i = x_c + self.current_block_coord[0]
-            for y in range(-self.settings.num_blocks - 1, self.settings.num_blocks + 2, 1):
-                y_c = y * self.settings.block_size
-                y_i = y_c + self.current_block_coord[1]
-                self.block_grid_tracker[(x_c, y_c)] = copy.copy(state)
-                if (x == -self.settings.num_blocks - 1) or (x == self.settings.num_blocks + 1):
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = True
-                elif (y == -self.settings.num_blocks - 1) or (y == self.settings.num_blocks + 1):
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = True
-                else:
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = False
-                self.map_grid_block2coords[(x_i, y_i)] = (x_c, y_c)
+
+    def reset_block_grid(self) -> None:
+        """
+        Resets the state of all the blocks in the grid. The arrays are filled in place.
+        """
+
+        for key, value in self.get_block_reset_values().items():
+            self.block_grid_tracker[key].fill(value)
+
+    def get_grid_index(self, coordinates: Tuple[float, float]) -> Tuple[int, int]:
+        """
+        Returns the indices of the block matching the given coordinates in the block grid.
+
+        Args:
+            coordinates (Tuple[float, float]): Coordinates of the block in the low resolution
+                DEM frame.
+
+        Returns:
+            Tuple[int, int]: Indices of the block in the grid, None if the block is not in the grid.
+        """
+
+        ix = int(round((coordinates[0] - self.current_block_coord[0]) / self.settings.block_size))
+        iy = int(round((coordinates[1] - self.current_block_coord[1]) / self.settings.block_size))
+        ix += self.settings.num_blocks + 1
+        iy += self.settings.num_blocks + 1
+        if (ix < 0) or (ix >= self.grid_size) or (iy < 0) or (iy >= self.grid_size):
+            return None
+        return (ix, iy)
+
+    def get_block_coordinates(self, ix: int, iy: int) -> Tuple[float, float]:
+        """
+        Returns the coordinates of the block at the given indices in the block grid.
+
+        Args:
+            ix (int): Index of the block along the x axis of the grid.
+            iy (int): Index of the block along the y axis of the grid.
+
+        Returns:
+            Tuple[float, float]: Coordinates of the block in the low resolution DEM frame.
+        """
+
+        x_i = (int(ix) - self.settings.num_blocks - 1) * self.settings.block_size + self.current_block_coord[0]
+        y_i = (int(iy) - self.settings.num_blocks - 1) * self.settings.block_size + self.current_block_coord[1]
+        return (x_i, y_i)
 
     def shift_block_grid(self, coordinates: Tuple[float, float]) -> None:
         """
         Shifts the block grid to the given coordinates while preserving the state of the
-        blocks. The function will also update the map_grid_block2coords dictionary to
-        reflect the new block coordinates.
+        blocks. The blocks that are still in the grid are moved to their new indices, the
+        blocks that enter the grid are reset. The padding mask does not change.
 
         Args:
             coordinates (Tuple[float, float]): Coordinates in meters in the low resolution
@@ -291,41 +459,28 @@ class HighResDEMGen:
         # that waits for one reconstruction to finish before starting the next one. The state could be
         # augmented to have a flag that says a given block is already being processed.
 
-        new_block_grid_tracker = {}
-        new_map_grid_block2coords = {}
-
-        for x in range(-self.settings.num_blocks - 1, self.settings.num_blocks + 2, 1):
-            x_c = x * self.settings.block_size
-            x_i = x_c + coordinates[0]
-            for y in range(-self.settings.num_blocks - 1, self.settings.num_blocks + 2, 1):
-                y_c = y * self.settings.block_size
-                y_i = y_c + coordinates[1]
-
-                # Check if the block is new or already in the map
-                if (x_i, y_i) not in self.map_grid_block2coords:
-                    # This block is not in the map, so it is a new block
-                    new_block_grid_tracker[(x_c, y_c)] = {
-                        "has_crater_metadata": not self.settings.generate_craters,
-                        "has_crater_data": not self.settings.generate_craters,
-                        "has_terrain_data": False,
-                        "is_padding": False,
-                    }
-                else:
-                    # This block is already in the map
-                    x_c_2, y_c_2 = self.map_grid_block2coords[(x_i, y_i)]
-                    new_block_grid_tracker[(x_c, y_c)] = self.block_grid_tracker[(x_c_2, y_c_2)]
-
-                new_map_grid_block2coords[(x_i, y_i)] = (x_c, y_c)
-                if (x == -self.settings.num_blocks - 1) or (x == self.settings.num_blocks + 1):
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = True
-                elif (y == -self.settings.num_blocks - 1) or (y == self.settings.num_blocks + 1):
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = True
-                else:
-                    self.block_grid_tracker[(x_c, y_c)]["is_padding"] = False
-
-        # Overwrite the old state with the new state
-        self.block_grid_tracker = new_block_grid_tracker
-        self.map_grid_block2coords = new_map_grid_block2coords
+        dx = int(round((coordinates[0] - self.current_block_coord[0]) / self.settings.block_size))
+        dy = int(round((coordinates[1] - self.current_block_coord[1]) / self.settings.block_size))
+        if (dx == 0) and (dy == 0):
+            return
+
+        if (abs(dx) >= self.grid_size) or (abs(dy) >= self.grid_size):
+            # None of the blocks are reused
+            self.reset_block_grid()
+            return
+
+        for key, value in self.get_block_reset_values().items():
+            flags = self.block_grid_tracker[key]
+            # The block at index i of the new grid was at index i + d in the old grid
+            flags[:, :] = np.roll(flags, (-dx, -dy), axis=(0, 1))
+            if dx > 0:
+                flags[-dx:, :] = value
+            elif dx < 0:
+                flags[:-dx, :] = value
+            if dy > 0:
+                flags[:, -dy:] = value
+            elif dy < 0:
+                flags[:, :-dy] = value
 
     def shift_dem(self, pixel_shift: Tuple[int, int]) -> None:
         """
@@ -336,61 +491,69 @@ class HighResDEMGen:
         when the simulation is "warm" the map only needs to update the new blocks,
         reducing the time required to compute them.
 
+        The DEM is shifted in place by a Numba kernel. The rows are copied in chunks that
+        are no larger than the shift, starting from the end the data moves towards, such
+        that the source and target of each copy never overlap. This avoids the temporary
+        copy numpy makes when assigning overlapping views. The pixels left uncovered by
+        the shift are set to 0.
+
+        The DEM is not stored as a ring buffer addressed through a moving origin, which
+        would avoid moving the data. The clipmaps and the colliders hold a reference to
+        the DEM, and index it as a regular array centered on the current block.
+
+        The range of the DEM is not recomputed here, it is only flagged as stale. It is
+        recomputed by get_dem_range, when it is read.
+
         Args:
             pixel_shift (Tuple[int, int]): Number of pixels to shift the high resolution
                 DEM in the pixel coordinate space.
         """
 
-        # TODO (antoine.richard / JAOPS): This function is not optimal and could be improved.
-        # Check if a np.roll function could be used to shift the DEM. This would be faster
-        # than copying the data. I would then have to set the shifted values to 0.
-
         x_shift, y_shift = pixel_shift
-        if x_shift > self.high_res_dem.shape[0] or y_shift > self.high_res_dem.shape[1]:
+        h, w = self.high_res_dem.shape
+        if (x_shift == 0) and (y_shift == 0):
+            return
+        self.dirty_revision += 1
+        if (abs(x_shift) >= h) or (abs(y_shift) >= w):
             # If the shift is larger than the DEM, reset the DEM
-            self.high_res_dem[:, :] = 0
+            _zero_fill(self.high_res_dem)
         else:
-            # Shift the DEM
-            if x_shift > 0:
-                x_min_s = 0
-                x_max_s = -x_shift
-                x_min_t = x_shift
-                x_max_t = self.high_res_dem.shape[0]
-            elif x_shift == 0:
-                x_min_s = 0
-                x_max_s = self.high_res_dem.shape[0]
-                x_min_t = 0
-                x_max_t = self.high_res_dem.shape[0]
-            else:
-                x_min_s = -x_shift
-                x_max_s = self.high_res_dem.shape[0]
-                x_min_t = 0
-                x_max_t = x_shift
-            if y_shift > 0:
-                y_min_s = 0
-                y_max_s = -y_shift
-                y_min_t = y_shift
-                y_max_t = self.high_res_dem.shape[1]
-            elif y_shift == 0:
-                y_min_s = 0
-                y_max_s = self.high_res_dem.shape[1]
-                y_min_t = 0
-                y_max_t = self.high_res_dem.shape[1]
-            else:
-                y_min_s = -y_shift
-                y_max_s = self.high_res_dem.shape[1]
-                y_min_t = 0
-                y_max_t = y_shift
-            # Copy the data
-            self.high_res_dem[x_min_t:x_max_t, y_min_t:y_max_t] = self.high_res_dem[x_min_s:x_max_s, y_min_s:y_max_s]
-            if x_shift < 0:
-                self.high_res_dem[x_max_t:, :] = 0
-            elif x_shift > 0:
-                self.high_res_dem[:x_min_t, :] = 0
-            if y_shift < 0:
-                self.high_res_dem[:, y_max_t:] = 0
-            elif y_shift > 0:
-                self.high_res_dem[:, :y_min_t] = 0
+            _shift_2d(self.high_res_dem, x_shift, y_shift)
+        self.dem_range_is_stale = True
+
+    def get_dem_range(self) -> Tuple[float, float]:
+        """
+        Gets the minimum and maximum of the high resolution DEM. After a shift, they are
+        recomputed from the blocks holding terrain or crater data. The blocks that are
+        still waiting for their data are ignored, and so are the values of the blocks
+        that left the grid. Otherwise, they are the ones tracked as the blocks are
+        deposited. The range is empty (min > max) while no block holds data.
+
+        Returns:
+            Tuple[float, float]: The minimum and maximum of the high resolution DEM.
+        """
+
+        if self.dem_range_is_stale:
+            self.update_dem_range()
+        return self.dem_min, self.dem_max
+
+    def update_dem_range(self) -> None:
+        """
+        Recomputes the minimum and maximum of the high resolution DEM from the blocks
+        holding terrain or crater data. This reads most of the DEM, hence it is only
+        called when the range is read, see get_dem_range.
+        """
+
+        bs = self.block_px
+        has_data = self.block_grid_tracker["has_terrain_data"] | self.block_grid_tracker["has_crater_data"]
+        self.dem_min = math.inf
+        self.dem_max = -math.inf
+        self.dem_range_is_stale = False
+        for ix, iy in np.argwhere(has_data):
+            x_px, y_px = self.block_px_offsets[ix, iy]
+            block_min, block_max = minmax(self.high_res_dem[x_px : x_px + bs, y_px : y_px + bs])
+            self.dem_min = min(self.dem_min, float(block_min))
+            self.dem_max = max(self.dem_max, float(block_max))
 
     def shift(self, coordinates: Tuple[float, float]) -> None:
         """
@@ -416,7 +579,6 @@ class HighResDEMGen:
         # even if the terrain reconstruction is not complete. This would prevent a full simulation lock
         # that waits for one reconstruction to finish before starting the next one.
 
-        print("Called shift")
         with ScopedTimer("Shift", active=self.profiling):
             # Compute initial coordinates in block space
             with ScopedTimer("Cast coordinates to block space", active=self.profiling):
@@ -446,7 +608,6 @@ class HighResDEMGen:
             with ScopedTimer("Add terrain blocks to queues", active=self.profiling):
                 # Asynchronous terrain block generation
                 self.generate_terrain_blocks()  # <-- This is the bit that needs to be edited to support multiple calls
-        print("Shift done")
 
     def get_height(self, coordinates: Tuple[float, float]) -> float:
         """
@@ -503,6 +664,20 @@ class HighResDEMGen:
         vec = vec / np.linalg.norm(vec)
         return vec
 
+    def get_complete_blocks_mask(self) -> np.ndarray:
+        """
+        Returns a mask of the blocks that have all the necessary data to render the terrain.
+
+        Returns:
+            np.ndarray: (G, G) boolean array, True if the block is complete, False otherwise.
+        """
+
+        return (
+            self.block_grid_tracker["has_crater_metadata"]
+            & self.block_grid_tracker["has_crater_data"]
+            & self.block_grid_tracker["has_terrain_data"]
+        )
+
     def list_missing_blocks(self) -> List[Tuple[int, int]]:
         """
         Lists the blocks that are missing the terrain data.
@@ -511,11 +686,13 @@ class HighResDEMGen:
             List[Tuple[int, int]]: List of blocks that are missing the terrain data.
         """
 
-        return [coords for coords in self.map_grid_block2coords.values() if not self.is_block_complete(coords)]
+        return [self.get_block_coordinates(ix, iy) for ix, iy in np.argwhere(~self.get_complete_blocks_mask())]
 
-    def is_block_complete(self, coord) -> bool:
-        block = self.block_grid_tracker[coord]
-        return block["has_crater_metadata"] and block["has_crater_data"] and block["has_terrain_data"]
+    def is_block_complete(self, coord: Tuple[float, float]) -> bool:
+        index = self.get_grid_index(coord)
+        if index is None:
+            return False
+        return bool(self.get_complete_blocks_mask()[index])
 
     def update_terrain_data_blocking(self, coords: Tuple[int, int]) -> None:
         """
@@ -530,8 +707,9 @@ class HighResDEMGen:
         if self.current_block_coord != block_coordinates:
             self.shift(block_coordinates)
             while (not self.is_map_done()) and (self.monitor_thread.thread.is_alive()):
-                self.collect_terrain_data()
-                time.sleep(0.1)
+                # Only waits once all the available tiles were collected.
+                if not self.collect_terrain_data():
+                    time.sleep(0.1)
 
     def update_high_res_dem(self, coords: Tuple[float, float]) -> bool:
         """
@@ -563,7 +741,7 @@ class HighResDEMGen:
 
         # Initial map generation
         if not self.sim_is_warm:
-            print("Warming up simulation")
+            logger.debug("Warming up simulation")
             self.shift(block_coordinates)
             # Threaded update, the function will return before the update is done
             threading.Thread(target=self.threaded_high_res_dem_update).start()
@@ -572,21 +750,20 @@ class HighResDEMGen:
 
         # Map update if the block has changed
         if self.current_block_coord != block_coordinates:
-            print("Triggering high res DEM update")
+            logger.debug("Triggering high res DEM update")
             if not self.terrain_is_primed:
-                print("Map is not done, waiting for the terrain data")
+                logger.debug("Map is not done, waiting for the terrain data")
                 while not self.terrain_is_primed:
                     time.sleep(0.2)
-                    print([self.block_grid_tracker[coord] for coord in self.list_missing_blocks()])
-                    # print(self.crater_builder_manager.get_load_per_worker())
-                    # print(self.interpolator_manager.get_load_per_worker())
-                print("Map is done carrying on")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Missing blocks: %s", self.list_missing_blocks())
+                logger.debug("Map is done carrying on")
             # Threaded update, the function will return before the update is done
             if self.thread is None:
                 self.shift(coords)
                 self.thread = threading.Thread(target=self.threaded_high_res_dem_update).start()
             elif self.thread.is_alive():
-                print("Thread is alive waiting for it to finish")
+                logger.debug("Thread is alive waiting for it to finish")
                 while self.thread.is_alive():
                     time.sleep(0.1)
                 self.shift(coords)
@@ -607,14 +784,7 @@ class HighResDEMGen:
             bool: True if all the blocks have the necessary data, False otherwise.
         """
 
-        return all(
-            [
-                self.block_grid_tracker[coords]["has_crater_metadata"]
-                and self.block_grid_tracker[coords]["has_crater_data"]
-                and self.block_grid_tracker[coords]["has_terrain_data"]
-                for coords in self.map_grid_block2coords.values()
-            ]
-        )
+        return bool(np.all(self.get_complete_blocks_mask()))
 
     def threaded_high_res_dem_update(self) -> None:
         """
@@ -626,12 +796,16 @@ class HighResDEMGen:
         # even if the terrain reconstruction is not complete. This would prevent a full simulation lock
         # that waits for one reconstruction to finish before starting the next one.
 
-        print("Opening thread")
+        logger.debug("Opening thread")
         self.terrain_is_primed = False
         while (not self.is_map_done()) and (self.monitor_thread.thread.is_alive()):
-            self.collect_terrain_data()
-            time.sleep(0.1)
-        print("Thread closing map is done")
+            if self.collect_terrain_data():
+                # More tiles are waiting, they are collected right away.
+                continue
+            # Wakes up as soon as a worker outputs a result
+            self.progress_event.wait(0.1)
+            self.progress_event.clear()
+        logger.debug("Thread closing map is done")
         self.terrain_is_primed = True
 
     def generate_craters_metadata(self, new_block_coord) -> None:
@@ -652,14 +826,13 @@ class HighResDEMGen:
         )
         self.crater_sampler.sample_craters_by_region(region)
         # Check if the block has crater data (it should always be true)
-        for coords in self.map_grid_block2coords.keys():
-            exists = self.crater_db.check_block_exists(coords)
-            local_coords = self.map_grid_block2coords[coords]
-            if exists:
-                self.block_grid_tracker[local_coords]["has_crater_metadata"] = True
-            else:
-                self.block_grid_tracker[local_coords]["has_crater_metadata"] = False
-                print(f"Block {coords} does not have crater metadata")
+        has_crater_metadata = self.block_grid_tracker["has_crater_metadata"]
+        for ix in range(self.grid_size):
+            for iy in range(self.grid_size):
+                coords = self.get_block_coordinates(ix, iy)
+                has_crater_metadata[ix, iy] = self.crater_db.check_block_exists(coords)
+                if not has_crater_metadata[ix, iy]:
+                    logger.debug("Block %s does not have crater metadata", coords)
 
     def querry_low_res_dem(self, coordinates: Tuple[float, float]) -> np.ndarray:
         """
@@ -673,23 +846,51 @@ class HighResDEMGen:
 
         Returns:
             np.ndarray: Patch of the low resolution DEM data for the block matching the
-                coordinates.
+                coordinates. float32.
         """
 
         lr_dem_coordinates = (
             int(coordinates[0] / self.settings.source_resolution + self.lr_dem_px_offset[0]),
             int(coordinates[1] / self.settings.source_resolution + self.lr_dem_px_offset[1]),
         )
-        return self.low_res_dem[
-            lr_dem_coordinates[0]
-            - self.settings.interpolation_padding : lr_dem_coordinates[0]
-            + self.lr_dem_block_size
-            + self.settings.interpolation_padding,
-            lr_dem_coordinates[1]
-            - self.settings.interpolation_padding : lr_dem_coordinates[1]
-            + self.lr_dem_block_size
-            + self.settings.interpolation_padding,
-        ]
+        # Blocks aligned with the block grid are read from the precomputed patches.
+        if self.lr_dem_patches is not None:
+            dx = lr_dem_coordinates[0] - self.settings.interpolation_padding - self.lr_dem_patches_start[0]
+            dy = lr_dem_coordinates[1] - self.settings.interpolation_padding - self.lr_dem_patches_start[1]
+            ix, rx = divmod(dx, self.lr_dem_block_size)
+            iy, ry = divmod(dy, self.lr_dem_block_size)
+            if (
+                (rx == 0)
+                and (ry == 0)
+                and (0 <= ix < self.lr_dem_patches.shape[0])
+                and (0 <= iy < self.lr_dem_patches.shape[1])
+            ):
+                return np.ascontiguousarray(self.lr_dem_patches[ix, iy], dtype=np.float32)
+        # Otherwise the patch is sliced from the low resolution DEM.
+        return self._sample_lowres(
+            lr_dem_coordinates[0] - self.settings.interpolation_padding,
+            lr_dem_coordinates[0] + self.lr_dem_block_size + self.settings.interpolation_padding,
+            lr_dem_coordinates[1] - self.settings.interpolation_padding,
+            lr_dem_coordinates[1] + self.lr_dem_block_size + self.settings.interpolation_padding,
+        )
+
+    def _sample_lowres(self, x0: int, x1: int, y0: int, y1: int) -> np.ndarray:
+        """
+        Reads a patch of the low resolution DEM. If the DEM is memory mapped, only the
+        patch is read from the disk. The patch is cast to float32, the type used by the
+        interpolators, whatever the type the DEM was saved with.
+
+        Args:
+            x0 (int): First row of the patch. (pixels)
+            x1 (int): Row after the last row of the patch. (pixels)
+            y0 (int): First column of the patch. (pixels)
+            y1 (int): Column after the last column of the patch. (pixels)
+
+        Returns:
+            np.ndarray: Patch of the low resolution DEM. float32.
+        """
+
+        return np.ascontiguousarray(self.low_res_dem[x0:x1, y0:y1], dtype=np.float32)
 
     def get_coordinates(self, coordinates: Tuple[float, float]) -> Tuple[float, float]:
         """
@@ -734,79 +935,102 @@ class HighResDEMGen:
         # needs to check if the requested block is already being processed and if it is, skip it.
 
         # Generate terrain data for + 1 block in each direction
-        for grid_key in self.map_grid_block2coords.keys():
-            x_i = grid_key[0]  # + self.current_block_coord[0]
-            y_i = grid_key[1]  # + self.current_block_coord[1]
-            coords = (x_i, y_i)
-            grid_coords = self.map_grid_block2coords[grid_key]
-            if not self.block_grid_tracker[grid_coords]["has_crater_data"]:
-                self.crater_builder_manager.process_data(coords, self.crater_db.get_block_data_with_neighbors(coords))
-            if not self.block_grid_tracker[grid_coords]["has_terrain_data"]:
-                self.interpolator_manager.process_data(coords, self.querry_low_res_dem(coords))
-
-    def collect_terrain_data(self) -> None:
+        # The crater jobs are sent in batches to reduce the number of messages exchanged with the workers.
+        crater_coords = [
+            self.get_block_coordinates(ix, iy) for ix, iy in np.argwhere(~self.block_grid_tracker["has_crater_data"])
+        ]
+        self.crater_builder_manager.process_data_batch(
+            crater_coords, [self.crater_db.get_block_records_with_neighbors(coords) for coords in crater_coords]
+        )
+        for ix, iy in np.argwhere(~self.block_grid_tracker["has_terrain_data"]):
+            coords = self.get_block_coordinates(ix, iy)
+            self.interpolator_manager.process_data(coords, self.querry_low_res_dem(coords))
+
+    def collect_terrain_data(self, max_tiles: int = 64) -> bool:
         """
         Collects the terrain data from the workers and updates the high resolution DEM
         with the new terrain data. This is required to collect the output of the workers
-        and update the high resolution DEM with it.
-        """
+        and update the high resolution DEM with it. At most max_tiles terrain tiles, and
+        max_tiles crater tiles, are collected per call, such that a call does not hold
+        the DEM for long when many results are waiting.
 
-        # Offset to account for the padding blocks
-        offset = int((self.settings.num_blocks + 1) * self.settings.block_size / self.settings.resolution)
-        print("collecting...")
-        # Collect the results from the workers responsible for adding craters
-        crater_results = self.crater_builder_manager.collect_results()
-        for coords, data in crater_results:
-            x_i, y_i = coords
-            x_c, y_c = self.map_grid_block2coords[(x_i, y_i)]
-            local_coords = (x_c, y_c)
-            self.high_res_dem[
-                int(x_c / self.settings.resolution)
-                + offset : int((x_c + self.settings.block_size) / self.settings.resolution)
-                + offset,
-                int(y_c / self.settings.resolution)
-                + offset : int((y_c + self.settings.block_size) / self.settings.resolution)
-                + offset,
-            ] += data
-            self.block_grid_tracker[local_coords]["has_crater_data"] = True
+        If any block was updated, the revision of the DEM is incremented, and the running
+        minimum and maximum are updated from the updated blocks only. They are computed
+        while the tiles are added to the DEM, such that the blocks are not read again.
+
+        Args:
+            max_tiles (int): The maximum number of tiles of each kind to collect. If None,
+                all the available tiles are collected.
 
+        Returns:
+            bool: True if the limit was reached, hence more tiles may be waiting.
+        """
+
+        bs = self.block_px
         # Collect the results from the workers responsible for interpolating the terrain
-        terrain_results = self.interpolator_manager.collect_results()
-        for coords, data in terrain_results:
-            x_i, y_i = coords
-            x_c, y_c = self.map_grid_block2coords[(x_i, y_i)]
-            local_coords = (x_c, y_c)
-            self.high_res_dem[
-                int(x_c / self.settings.resolution)
-                + offset : int((x_c + self.settings.block_size) / self.settings.resolution)
-                + offset,
-                int(y_c / self.settings.resolution)
-                + offset : int((y_c + self.settings.block_size) / self.settings.resolution)
-                + offset,
-            ] += data
-            self.block_grid_tracker[local_coords]["has_terrain_data"] = True
+        # and from the workers responsible for adding craters.
+        terrain_coords, terrain_tiles = self.interpolator_manager.collect_stacked_results((bs, bs), max_tiles)
+        crater_coords, crater_tiles = self.crater_builder_manager.collect_stacked_results((bs, bs), max_tiles)
+
+        # Pair the terrain and crater tiles of each block such that the DEM is only updated once
+        # per block. If a block was received twice, the extra tiles are added separately.
+        # Blocks that are no longer in the grid are dropped.
+        block_tiles = {}
+        extra_tiles = []
+        for i, coords in enumerate(terrain_coords):
+            index = self.get_grid_index(coords)
+            if index is None:
+                continue
+            if index in block_tiles:
+                extra_tiles.append((index, terrain_tiles[i]))
+            else:
+                block_tiles[index] = [i, -1]
+            self.block_grid_tracker["has_terrain_data"][index] = True
+        for i, coords in enumerate(crater_coords):
+            index = self.get_grid_index(coords)
+            if index is None:
+                continue
+            if index not in block_tiles:
+                block_tiles[index] = [-1, i]
+            elif block_tiles[index][1] == -1:
+                block_tiles[index][1] = i
+            else:
+                extra_tiles.append((index, crater_tiles[i]))
+            self.block_grid_tracker["has_crater_data"][index] = True
+
+        if block_tiles:
+            offsets = np.array([self.block_px_offsets[index] for index in block_tiles], dtype=np.int64)
+            tile_ids = np.array(list(block_tiles.values()), dtype=np.int64)
+            block_min = np.empty(len(block_tiles), dtype=np.float32)
+            block_max = np.empty(len(block_tiles), dtype=np.float32)
+            _deposit(self.high_res_dem, terrain_tiles, crater_tiles, offsets, tile_ids, bs, block_min, block_max)
+            self.dirty_revision += 1
+            self.dem_min = min(self.dem_min, float(block_min.min()))
+            self.dem_max = max(self.dem_max, float(block_max.max()))
+        for index, data in extra_tiles:
+            x_px, y_px = self.block_px_offsets[index]
+            block = self.high_res_dem[x_px : x_px + bs, y_px : y_px + bs]
+            np.add(block, data, out=block)
+            block_min, block_max = minmax(block)
+            self.dem_min = min(self.dem_min, float(block_min))
+            self.dem_max = max(self.dem_max, float(block_max))
+        return (max_tiles is not None) and (max(len(terrain_coords), len(crater_coords)) >= max_tiles)
 
     def shutdown(self) -> None:
         """
         Shuts down the high resolution DEM generation. This will shutdown the workers
-        and the main worker manager.
+        and the main worker manager. Calling this function more than once has no effect.
         """
 
         self.monitor_thread.event.set()
         self.crater_builder_manager.shutdown()
         self.interpolator_manager.shutdown()
 
-    def __del__(self) -> None:
-        """
-        Destructor for the HighResDEMGen class. It will call the shutdown function to
-        ensure that all the workers are properly shutdown.
-        """
+    def __enter__(self) -> "HighResDEMGen":
+        return self
 
-        # Try except to avoid errors when the shutdown is called multiple times
-        try:
-            self.shutdown()
-        except Exception as e:
-            pass
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.shutdown()
 
 
 if __name__ == "__main__":
@@ -883,134 +1107,97 @@ if __name__ == "__main__":
     }
 
     settings = HighResDEMGenConf(**HRDEMGenCfg_D)
-    low_res_dem = np.load("assets/Terrains/SouthPole/NPD_final_adj_5mpp_surf/dem.npy")
+    low_res_dem = np.load("assets/Terrains/SouthPole/NPD_final_adj_5mpp_surf/dem.npy", mmap_mode="r")
     HRDEMGen = HighResDEMGen(low_res_dem, settings)
 
     from matplotlib import pyplot as plt
-    import matplotlib.colors as mcolors
+    from matplotlib import colors as mcolors
+    import queue
     import time
 
+    class CollectorThread(threading.Thread):
+        """
+        Collects the results of the workers as soon as they are available, and publishes
+        the frames to render. Matplotlib's GUI backends must be driven from the main thread,
+        hence the collection runs in this thread, and the rendering in the main thread.
+        Only the latest frame is kept, older frames are dropped.
+        """
+
+        def __init__(self, hrdem: HighResDEMGen) -> None:
+            super().__init__(daemon=True)
+            self.hrdem = hrdem
+            # Prevents the DEM from being shifted while the results are collected.
+            self.lock = threading.Lock()
+            self.frames = queue.Queue(maxsize=1)
+            self.stop_event = threading.Event()
+
+        def publish(self) -> None:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.frames.put_nowait(self.hrdem.get_dem_range())
+
+        def run(self) -> None:
+            has_more = False
+            while not self.stop_event.is_set():
+                if not has_more:
+                    self.hrdem.progress_event.wait(0.1)
+                    self.hrdem.progress_event.clear()
+                # The lock is released between batches such that shifts are not delayed.
+                with self.lock:
+                    revision = self.hrdem.dirty_revision
+                    has_more = self.hrdem.collect_terrain_data()
+                    if self.hrdem.dirty_revision != revision:
+                        self.publish()
+
+    def _draw(im_data, bg, data, vmin, vmax, hysteresis=0.02):
+        # Only the image is redrawn on top of the cached background. The norm is kept, and
+        # its limits only follow the range of the DEM once it moved by more than the hysteresis.
+        # The range is empty (vmin > vmax) while no block holds data.
+        fig = im_data.figure
+        im_data.set_data(data)
+        if vmin <= vmax:
+            tol = hysteresis * (vmax - vmin)
+            if (abs(im_data.norm.vmin - vmin) > tol) or (abs(im_data.norm.vmax - vmax) > tol):
+                im_data.set_clim(vmin, vmax)
+        fig.canvas.restore_region(bg)
+        im_data.axes.draw_artist(im_data)
+        fig.canvas.blit(im_data.axes.bbox)
+        fig.canvas.flush_events()
+
+    def _render(hrdem, collector, im_data, bg):
+        # Renders the published frames until all the results of the workers are collected.
+        # The timeout keeps the window responsive while the workers are busy.
+        while True:
+            done = hrdem.crater_builder_manager.is_fully_drained() and hrdem.interpolator_manager.is_fully_drained()
+            try:
+                vmin, vmax = collector.frames.get(timeout=0.1)
+                _draw(im_data, bg, hrdem.high_res_dem, vmin, vmax)
+            except queue.Empty:
+                im_data.figure.canvas.flush_events()
+                if done:
+                    break
+
     # Initial Generation
-    HRDEMGen.shift((0, 0))
-    time.sleep(2.0)
-    plt.figure()
-    im_data = None
-    while (not HRDEMGen.crater_builder_manager.is_output_queue_empty()) or (
-        not HRDEMGen.crater_builder_manager.are_workers_done()
-        or (not HRDEMGen.crater_builder_manager.is_input_queue_empty())
-    ):
-        HRDEMGen.collect_terrain_data()
-        norm = mcolors.Normalize(vmin=HRDEMGen.high_res_dem.min(), vmax=HRDEMGen.high_res_dem.max())
-        if im_data is None:
-            im_data = plt.imshow(HRDEMGen.high_res_dem, cmap="terrain", norm=norm)
-        else:
-            im_data.set_data(HRDEMGen.high_res_dem)
-            im_data.set_norm(norm)
-        plt.pause(0.25)
-        plt.draw()
-    time.sleep(5.0)
-    HRDEMGen.collect_terrain_data()
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-
-    # Rover has moved enough trigger new gen
-    HRDEMGen.shift((50, 0))
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-    while (not HRDEMGen.crater_builder_manager.is_output_queue_empty()) or (
-        not HRDEMGen.crater_builder_manager.are_workers_done()
-    ):
-        HRDEMGen.collect_terrain_data()
-        norm = mcolors.Normalize(vmin=HRDEMGen.high_res_dem.min(), vmax=HRDEMGen.high_res_dem.max())
-        im_data.set_data(HRDEMGen.high_res_dem)
-        im_data.set_norm(norm)
-        plt.pause(0.25)
-        plt.draw()
-    time.sleep(5.0)
-    HRDEMGen.collect_terrain_data()
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-
-    # Rover has moved some more trigger new gen
-    HRDEMGen.shift((50, 50))
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-    while (not HRDEMGen.crater_builder_manager.is_output_queue_empty()) or (
-        not HRDEMGen.crater_builder_manager.are_workers_done()
-    ):
-        HRDEMGen.collect_terrain_data()
-        norm = mcolors.Normalize(vmin=HRDEMGen.high_res_dem.min(), vmax=HRDEMGen.high_res_dem.max())
-        im_data.set_data(HRDEMGen.high_res_dem)
-        im_data.set_norm(norm)
-        plt.pause(0.25)
-        plt.draw()
-    time.sleep(5.0)
-    HRDEMGen.collect_terrain_data()
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-
-    # Rover has moved some more
-    HRDEMGen.shift((100, 100))
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-    while (not HRDEMGen.crater_builder_manager.is_output_queue_empty()) or (
-        not HRDEMGen.crater_builder_manager.are_workers_done()
-    ):
-        HRDEMGen.collect_terrain_data()
-        norm = mcolors.Normalize(vmin=HRDEMGen.high_res_dem.min(), vmax=HRDEMGen.high_res_dem.max())
-        im_data.set_data(HRDEMGen.high_res_dem)
-        im_data.set_norm(norm)
-        plt.pause(0.25)
-        plt.draw()
-    time.sleep(5.0)
-    HRDEMGen.collect_terrain_data()
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-
-    # Rover has moved some more
-    HRDEMGen.shift((0, 0))
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
-    while (not HRDEMGen.crater_builder_manager.is_output_queue_empty()) or (
-        not HRDEMGen.crater_builder_manager.are_workers_done()
-    ):
-        HRDEMGen.collect_terrain_data()
-        norm = mcolors.Normalize(vmin=HRDEMGen.high_res_dem.min(), vmax=HRDEMGen.high_res_dem.max())
-        im_data.set_data(HRDEMGen.high_res_dem)
-        im_data.set_norm(norm)
-        plt.pause(0.25)
-        plt.draw()
-    time.sleep(5.0)
-    HRDEMGen.collect_terrain_data()
-    im_data.set_data(HRDEMGen.high_res_dem)
-    im_data.set_norm(norm)
-    plt.pause(0.25)
-    plt.draw()
-    time.sleep(5.0)
+    fig, ax = plt.subplots()
+    # The limits are set from the range of the DEM once the first blocks are deposited.
+    norm = mcolors.Normalize(vmin=0.0, vmax=1.0)
+    im_data = ax.imshow(HRDEMGen.high_res_dem, cmap="terrain", norm=norm, animated=True)
+    plt.show(block=False)
+    fig.canvas.draw()
+    bg = fig.canvas.copy_from_bbox(ax.bbox)
+    collector = CollectorThread(HRDEMGen)
+    collector.start()
+
+    # Rover moves enough to trigger new generations
+    for coords in [(0, 0), (50, 0), (50, 50), (100, 100), (0, 0)]:
+        with collector.lock:
+            HRDEMGen.shift(coords)
+            collector.publish()
+        _render(HRDEMGen, collector, im_data, bg)
+    collector.stop_event.set()
+    collector.join()
 
     plt.figure()
     s = time.time()
@@ -0,0 +1,334 @@
+__author__ = "Antoine Richard"
+__copyright__ = "Copyright 2023-24, Space Robotics Lab, SnT, University of Luxembourg, SpaceR"
+__license__ = "BSD 3-Clause"
+__version__ = "2.0.0"
+__maintainer__ = "Antoine Richard"
+__email__ = "antoine.richard@uni.lu"
+__status__ = "development"
+
+from typing import Tuple
+import numba as nb
+import numpy as np
+import os
+
+from src.terrain_management.large_scale_terrain.utils import eval_cubic, eval_piecewise_cubic, rotate_cubic, minmax
+
+
+@nb.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _zero_fill(arr):
+    """
+    Sets all the values of a 2D array to 0. The rows are filled in parallel, such
+    that the pages of a freshly allocated array are first touched by several threads.
+
+    Args:
+        arr (np.ndarray): Array to fill in place. (H, W)
+    """
+
+    for i in nb.prange(arr.shape[0]):
+        for j in range(arr.shape[1]):
+            arr[i, j] = 0
+
+
+@nb.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _deposit(dem, tiles_base, tiles_crater, offsets, tile_ids, bs, block_min, block_max):
+    """
+    Adds the terrain and crater tiles to the high resolution DEM in a single pass.
+    Each block of the DEM is read and written once, even if both its terrain and its
+    crater tiles are available. The blocks are processed in parallel, hence, a block
+    must not appear more than once in the offsets. The minimum and maximum of each
+    updated block are computed as the values are written.
+
+    Args:
+        dem (np.ndarray): High resolution DEM to update in place. (H, W) float32.
+        tiles_base (np.ndarray): Interpolated terrain tiles. (N, bs, bs) float32.
+        tiles_crater (np.ndarray): Crater tiles. (M, bs, bs) float32.
+        offsets (np.ndarray): Pixel coordinates of the top left corner of each block. (K, 2) int64.
+        tile_ids (np.ndarray): Index of the terrain and crater tiles for each block, -1 if the
+            block has no such tile. (K, 2) int64.
+        bs (int): Size of the blocks in pixels.
+        block_min (np.ndarray): Minimum of each updated block, written in place. (K,) float32.
+        block_max (np.ndarray): Maximum of each updated block, written in place. (K,) float32.
+    """
+
+    for k in nb.prange(offsets.shape[0]):
+        x = offsets[k, 0]
+        y = offsets[k, 1]
+        a = tile_ids[k, 0]
+        b = tile_ids[k, 1]
+        mn = np.inf
+        mx = -np.inf
+        if (a >= 0) and (b >= 0):
+            for i in range(bs):
+                for j in range(bs):
+                    v = dem[x + i, y + j] + tiles_base[a, i, j] + tiles_crater[b, i, j]
+                    dem[x + i, y + j] = v
+                    mn = min(mn, v)
+                    mx = max(mx, v)
+        elif a >= 0:
+            for i in range(bs):
+                for j in range(bs):
+                    v = dem[x + i, y + j] + tiles_base[a, i, j]
+                    dem[x + i, y + j] = v
+                    mn = min(mn, v)
+                    mx = max(mx, v)
+        elif b >= 0:
+            for i in range(bs):
+                for j in range(bs):
+                    v = dem[x + i, y + j] + tiles_crater[b, i, j]
+                    dem[x + i, y + j] = v
+                    mn = min(mn, v)
+                    mx = max(mx, v)
+        block_min[k] = mn
+        block_max[k] = mx
+
+
+def _keys_cubic_weights(
+    num_source: int, num_target: int, scale: float, start: int, alpha: float = -0.5
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the 4-tap weights and source indices of a bicubic convolution along one axis.
+    The weights follow Keys' cubic convolution kernel. Pixel centers are aligned the same
+    way PIL and cv2 align them. Source indices are clamped to the edge of the source.
+
+    Args:
+        num_source (int): Number of source pixels.
+        num_target (int): Number of target pixels to compute.
+        scale (float): Ratio between the target and the source resolutions.
+        start (int): Index of the first target pixel to compute.
+        alpha (float): Parameter of the kernel. -0.5 gives the third order convergent kernel.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Weights (num_target, 4) float32, and source indices (num_target, 4) int64.
+    """
+
+    x = (np.arange(start, start + num_target, dtype=np.float64) + 0.5) / scale - 0.5
+    x0 = np.floor(x)
+    taps = x0[:, None] + np.arange(-1, 3)[None, :]
+    d = np.abs(x[:, None] - taps)
+    w = np.where(
+        d <= 1,
+        (alpha + 2) * d**3 - (alpha + 3) * d**2 + 1,
+        np.where(d < 2, alpha * d**3 - 5 * alpha * d**2 + 8 * alpha * d - 4 * alpha, 0.0),
+    )
+    idx = np.clip(taps, 0, num_source - 1).astype(np.int64)
+    return w.astype(np.float32), idx
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _bicubic_fixed(src, wx, col_idx, wy, row_idx, out):
+    """
+    Separable bicubic interpolation with precomputed weights. A horizontal pass
+    interpolates every source row into a scratch buffer. A vertical pass then
+    interpolates the scratch buffer into the output.
+
+    This kernel runs inside the interpolation workers, which already work in parallel,
+    hence it is not parallel itself. This also keeps the workers from using a thread
+    pool inherited from the process they were forked from.
+
+    Args:
+        src (np.ndarray): Source data. (H, W) float32.
+        wx (np.ndarray): Horizontal weights. (out_w, 4) float32.
+        col_idx (np.ndarray): Source column of each horizontal tap. (out_w, 4) int64.
+        wy (np.ndarray): Vertical weights. (out_h, 4) float32.
+        row_idx (np.ndarray): Source row of each vertical tap. (out_h, 4) int64.
+        out (np.ndarray): Output buffer. (out_h, out_w) float32.
+    """
+
+    out_w = wx.shape[0]
+    tmp = np.empty((src.shape[0], out_w), dtype=np.float32)
+    for r in range(src.shape[0]):
+        for j in range(out_w):
+            tmp[r, j] = (
+                wx[j, 0] * src[r, col_idx[j, 0]]
+                + wx[j, 1] * src[r, col_idx[j, 1]]
+                + wx[j, 2] * src[r, col_idx[j, 2]]
+                + wx[j, 3] * src[r, col_idx[j, 3]]
+            )
+    for i in range(wy.shape[0]):
+        r0 = row_idx[i, 0]
+        r1 = row_idx[i, 1]
+        r2 = row_idx[i, 2]
+        r3 = row_idx[i, 3]
+        for j in range(out_w):
+            out[i, j] = wy[i, 0] * tmp[r0, j] + wy[i, 1] * tmp[r1, j] + wy[i, 2] * tmp[r2, j] + wy[i, 3] * tmp[r3, j]
+
+
+def _make_bicubic_upsample_kernel(ratio: int, padding: int, alpha: float = -0.5):
+    """
+    Builds a bicubic interpolation kernel specialized for an integer upsampling ratio.
+    With an integer ratio, the weights of a target pixel only depend on its position
+    within its source pixel, its phase. The weights of the phases, the offsets of their
+    taps, and the ratio are baked in the kernel as constants, such that the compiler can
+    unroll the loop over the phases and fold the weight addressing. This requires the
+    padding to be at least 2 source pixels, such that no tap falls outside of the source.
+
+    The kernel is compiled when it is built. This is meant to happen before the workers
+    are forked, such that each worker inherits the compiled kernel.
+
+    Args:
+        ratio (int): Ratio between the target and the source resolutions.
+        padding (int): Padding of the source data, removed from the output. (source pixels)
+        alpha (float): Parameter of the kernel. -0.5 gives the third order convergent kernel.
+
+    Returns:
+        numba.core.registry.CPUDispatcher: The kernel, with the signature kernel(src, out).
+        src is the padded source data (H, W) float32, and out the output buffer
+        (ratio * (H - 2 * padding), ratio * (W - 2 * padding)) float32.
+    """
+
+    # The phases of the first source pixel after the padding share their weights with all the others.
+    w, idx = _keys_cubic_weights(padding + 3, ratio, float(ratio), padding * ratio, alpha)
+    W = np.ascontiguousarray(w)
+    # Index of the first tap of each phase, relative to the source pixel the target pixel is in.
+    O = np.ascontiguousarray(idx[:, 0] - padding)
+    R = ratio
+    P = padding
+
+    @nb.njit(fastmath=True, boundscheck=False)
+    def upsample(src, out):
+        h = src.shape[0] - 2 * P
+        w = src.shape[1] - 2 * P
+        tmp = np.empty((src.shape[0], w * R), dtype=np.float32)
+        for r in range(src.shape[0]):
+            for b in range(w):
+                c = P + b
+                for q in range(R):
+                    s = c + O[q]
+                    tmp[r, b * R + q] = (
+                        W[q, 0] * src[r, s]
+                        + W[q, 1] * src[r, s + 1]
+                        + W[q, 2] * src[r, s + 2]
+                        + W[q, 3] * src[r, s + 3]
+                    )
+        for b in range(h):
+            c = P + b
+            for q in range(R):
+                s = c + O[q]
+                i = b * R + q
+                for j in range(w * R):
+                    out[i, j] = (
+                        W[q, 0] * tmp[s, j]
+                        + W[q, 1] * tmp[s + 1, j]
+                        + W[q, 2] * tmp[s + 2, j]
+                        + W[q, 3] * tmp[s + 3, j]
+                    )
+
+    upsample.compile((nb.float32[:, ::1], nb.float32[:, ::1]))
+    return upsample
+
+
+@nb.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _shift_2d(dem, sx, sy):
+    """
+    Shifts a 2D array in place and sets the uncovered values to 0. Both shifts must be
+    smaller than the array. When shifting along the rows, the rows are copied in chunks
+    of sx rows, starting from the end the data moves towards. The rows of a chunk do not
+    overlap with their sources, hence they are copied in parallel without a temporary.
+    When only shifting along the columns, each row is shifted on its own, in parallel.
+
+    Args:
+        dem (np.ndarray): Array to shift in place. (H, W)
+        sx (int): Shift along the rows. (pixels)
+        sy (int): Shift along the columns. (pixels)
+    """
+
+    h = dem.shape[0]
+    w = dem.shape[1]
+    # Columns copied within each row
+    if sy >= 0:
+        ts = sy
+        ss = 0
+        n = w - sy
+    else:
+        ts = 0
+        ss = -sy
+        n = w + sy
+
+    if sx != 0:
+        step = abs(sx)
+        num_chunks = (h - 1) // step
+        for c in range(num_chunks):
+            if sx > 0:
+                end = h - c * step
+                start = max(end - step, sx)
+            else:
+                start = c * step
+                end = min(start + step, h - step)
+            for r in nb.prange(start, end):
+                sr = r - sx
+                for j in range(n):
+                    dem[r, ts + j] = dem[sr, ss + j]
+    elif sy > 0:
+        for r in nb.prange(h):
+            for j in range(n - 1, -1, -1):
+                dem[r, ts + j] = dem[r, ss + j]
+    elif sy < 0:
+        for r in nb.prange(h):
+            for j in range(n):
+                dem[r, ts + j] = dem[r, ss + j]
+
+    # Reset the uncovered values
+    for r in nb.prange(h):
+        if ((sx > 0) and (r < sx)) or ((sx < 0) and (r >= h + sx)):
+            for j in range(w):
+                dem[r, j] = 0
+        elif sy > 0:
+            for j in range(sy):
+                dem[r, j] = 0
+        elif sy < 0:
+            for j in range(w + sy, w):
+                dem[r, j] = 0
+
+
+def set_threading_layer_priority() -> None:
+    """
+    Numba picks its threading layer once, the first time a parallel kernel is compiled or
+    launched in the process. A process that forks while running a TBB thread pool hangs on
+    exit, and the workers are forked after parallel kernels ran, e.g. when the crater profiles
+    are generated, or when the map is reloaded. Hence, unless the NUMBA_THREADING_LAYER or
+    NUMBA_THREADING_LAYER_PRIORITY environment variables are set, OpenMP is preferred over TBB.
+
+    This setting is process wide, and has no effect if parallel kernels already ran in the
+    process. Setting NUMBA_THREADING_LAYER=omp in the environment of the simulator ensures
+    the same layer is used everywhere.
+    """
+
+    if ("NUMBA_THREADING_LAYER" not in os.environ) and ("NUMBA_THREADING_LAYER_PRIORITY" not in os.environ):
+        nb.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+
+def warmup_worker_kernels() -> None:
+    """
+    Compiles the serial kernels used by the workers for the types used at runtime.
+    They do not start Numba's thread pool, hence this can be called before the workers
+    are forked, and the workers inherit the compiled kernels instead of compiling them,
+    or loading them from the cache, on their first job.
+
+    The compiled kernels are cached on disk, hence, the compilation only happens once,
+    and the next runs only load them from the cache. The kernels are compiled from their
+    signatures instead of being called, such that no data needs to be allocated.
+    """
+
+    dem = nb.float32[:, ::1]
+    ids = nb.int64[:, ::1]
+    _bicubic_fixed.compile((dem, dem, ids, dem, ids, dem))
+    eval_cubic.compile((nb.int16[::1], nb.float64, nb.float64, nb.float64, dem, nb.float32[:, :, ::1]))
+    rotate_cubic.compile((dem, nb.float64, nb.float64, nb.float32[:, :, ::1]))
+    eval_piecewise_cubic.compile((nb.float64[:, ::1], nb.float64[::1], dem))
+
+
+def warmup_kernels() -> None:
+    """
+    Compiles the parallel kernels used by the main process for the types used at runtime,
+    such that the first update of the high resolution DEM does not stall on them. This
+    starts Numba's thread pool, hence it must be called after the workers are forked.
+    The compiled kernels are cached on disk, hence, the compilation only happens once.
+    """
+
+    dem = nb.float32[:, ::1]
+    tiles = nb.float32[:, :, ::1]
+    ids = nb.int64[:, ::1]
+    _zero_fill.compile((dem,))
+    _shift_2d.compile((dem, nb.int64, nb.int64))
+    _deposit.compile((dem, tiles, tiles, ids, ids, nb.int64, nb.float32[::1], nb.float32[::1]))
+    minmax.compile((nb.float32[:, :],))
@@ -6,20 +6,33 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
+from multiprocessing import shared_memory
 import multiprocessing.managers
 from typing import List, Tuple, Dict
 import multiprocessing
+import queue
 import numpy as np
 import dataclasses
 import threading
+import math
 import time
-import copy
+import logging
 import PIL
 import cv2
 
 from src.terrain_management.large_scale_terrain.crater_generation import (
     CraterBuilder,
 )
+from src.terrain_management.large_scale_terrain.utils import (
+    CRATER_METADATA_DTYPE,
+)
+from src.terrain_management.large_scale_terrain.high_resolution_DEM_numba import (
+    _keys_cubic_weights,
+    _bicubic_fixed,
+    _make_bicubic_upsample_kernel,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @dataclasses.dataclass
@@ -72,8 +85,12 @@ class Interpolator:
     Interpolator base class.
 
     The Interpolator class is responsible for interpolating the terrain data.
+    The start_method is the multiprocessing start method of the workers using the
+    interpolator. If None, the default start method is used.
     """
 
+    start_method = None
+
     def __init__(self, settings: InterpolatorConf):
         """
         Args:
@@ -102,13 +119,15 @@ class Interpolator:
 class CPUInterpolator(Interpolator):
     """
     An interpolator that uses the CPU to interpolate the terrain data.
-    This interpolator uses the cv2 library to interpolate the data.
+    Bicubic interpolation is done with a Numba kernel, other methods use cv2.
     In our testing, cv2 was generating nasty banding artifacts when
-    upscaling the data. So unless the upsampling factor is small, and
-    the data isn't smooth to start with, I'd recommend using the PIL
-    interpolator instead.
+    upscaling the data, because it uses an alpha value of -0.75 for its
+    bicubic kernel. The Numba kernel uses -0.5, like PIL.
 
-    The cv2 interpolator is faster than the PIL interpolator by about 4 times.
+    Since the upscaling ratio is fixed, the bicubic weights are identical
+    for every tile of a given shape. They are computed once, and only the
+    cropped region of the output is ever computed. When the ratio is an
+    integer, a kernel specialized for that ratio is used instead.
     """
 
     def __init__(self, settings: InterpolatorConf):
@@ -118,11 +137,48 @@ class CPUInterpolator(Interpolator):
         """
 
         super().__init__(settings)
+        self.weights_cache = {}
+        # Output buffers for cv2, one per input shape and type. Each worker process holds its own copy.
+        self.dst_buffers = {}
+        # The interpolator is built before the workers are forked, so they inherit the compiled kernel.
+        self.upsample_kernel = None
+        ratio = round(self.settings.fx)
+        if (
+            (self.settings.method == cv2.INTER_CUBIC)
+            and (self.settings.fx == self.settings.fy)
+            and (ratio > 1)
+            and (abs(self.settings.fx - ratio) < 1e-9)
+        ):
+            self.upsample_kernel = _make_bicubic_upsample_kernel(ratio, self.settings.source_padding)
+
+    def get_bicubic_weights(self, shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the bicubic weights and source indices for data of the given shape.
+        The weights only cover the output region that remains after cropping the padding.
+
+        Args:
+            shape (Tuple[int, int]): The shape of the data to interpolate.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The horizontal weights,
+            the source columns, the vertical weights and the source rows.
+        """
+
+        if shape not in self.weights_cache:
+            pad_x = int(self.settings.source_padding * self.settings.fx)
+            pad_y = int(self.settings.source_padding * self.settings.fy)
+            out_h = int(round(shape[0] * self.settings.fy)) - 2 * pad_y
+            out_w = int(round(shape[1] * self.settings.fx)) - 2 * pad_x
+            wy, row_idx = _keys_cubic_weights(shape[0], out_h, self.settings.fy, pad_y)
+            wx, col_idx = _keys_cubic_weights(shape[1], out_w, self.settings.fx, pad_x)
+            self.weights_cache[shape] = (wx, col_idx, wy, row_idx)
+        return self.weights_cache[shape]
 
     def interpolate(self, data: np.ndarray) -> np.ndarray:
         """
         Interpolates the given data using the settings of the interpolator.
-        The interpolation is done using cv2 resize.
+        The interpolation is done using a Numba kernel for bicubic interpolation,
+        and cv2 resize otherwise.
 
         Args:
             data (np.ndarray): The terrain data to interpolate.
@@ -131,20 +187,34 @@ class CPUInterpolator(Interpolator):
             np.ndarray: The interpolated terrain data.
         """
 
-        return cv2.resize(
+        if self.upsample_kernel is not None:
+            ratio = round(self.settings.fx)
+            pad = self.settings.source_padding
+            out = np.empty((ratio * (data.shape[0] - 2 * pad), ratio * (data.shape[1] - 2 * pad)), dtype=np.float32)
+            self.upsample_kernel(np.ascontiguousarray(data, dtype=np.float32), out)
+            return out
+        elif self.settings.method == cv2.INTER_CUBIC:
+            wx, col_idx, wy, row_idx = self.get_bicubic_weights(data.shape)
+            out = np.empty((wy.shape[0], wx.shape[0]), dtype=np.float32)
+            _bicubic_fixed(np.ascontiguousarray(data, dtype=np.float32), wx, col_idx, wy, row_idx, out)
+            return out
+
+        key = (data.shape, data.dtype)
+        if key not in self.dst_buffers:
+            self.dst_buffers[key] = np.empty(
+                (int(round(data.shape[0] * self.settings.fy)), int(round(data.shape[1] * self.settings.fx))),
+                dtype=data.dtype,
+            )
+        dst = self.dst_buffers[key]
+        cv2.resize(
             data,
-            (0, 0),
-            fx=self.settings.fx,
-            fy=self.settings.fy,
+            (dst.shape[1], dst.shape[0]),
+            dst=dst,
             interpolation=self.settings.method,
-        )[
-            int(self.settings.source_padding * self.settings.fx) : -int(
-                self.settings.source_padding * self.settings.fy
-            ),
-            int(self.settings.source_padding * self.settings.fx) : -int(
-                self.settings.source_padding * self.settings.fy
-            ),
-        ]
+        )
+        pad_x = int(self.settings.source_padding * self.settings.fx)
+        pad_y = int(self.settings.source_padding * self.settings.fy)
+        return dst[pad_y:-pad_y, pad_x:-pad_x].copy()
 
 
 class CPUInterpolator_PIL(Interpolator):
@@ -191,6 +261,327 @@ class CPUInterpolator_PIL(Interpolator):
         ]
 
 
+class GPUInterpolator(Interpolator):
+    """
+    An interpolator that uses a CUDA device to interpolate the terrain data.
+    This interpolator relies on CuPy, which is only imported the first time
+    data is interpolated, inside the workers. CUDA cannot be used in a forked
+    process once it was initialized in the parent, which is the case when the
+    simulator runs. Hence, the workers using this interpolator are spawned.
+
+    Note that CuPy's zoom uses spline interpolation. For bicubic interpolation the
+    result is smoother than the cubic convolution used by the CPU interpolators.
+    """
+
+    start_method = "spawn"
+
+    def __init__(self, settings: InterpolatorConf):
+        """
+        Args:
+            settings (InterpolatorCfg): The settings for the interpolator.
+        """
+
+        super().__init__(settings)
+
+        if self.settings.method == cv2.INTER_CUBIC:
+            self.order = 3
+        elif self.settings.method == cv2.INTER_LINEAR:
+            self.order = 1
+        elif self.settings.method == cv2.INTER_NEAREST:
+            self.order = 0
+        else:
+            raise ValueError("GPU interpolation only supports nearest, linear and bicubic interpolation.")
+        self.cp = None
+        self.ndimage = None
+        self.stream = None
+
+    def initialize(self) -> None:
+        """
+        Imports CuPy and creates the CUDA stream used by this interpolator.
+        """
+
+        import cupy
+        import cupyx.scipy.ndimage
+
+        self.cp = cupy
+        self.ndimage = cupyx.scipy.ndimage
+        self.stream = cupy.cuda.Stream(non_blocking=True)
+
+    def interpolate(self, data: np.ndarray) -> np.ndarray:
+        """
+        Interpolates the given data using the settings of the interpolator.
+        The data is uploaded to the device, zoomed, cropped, and downloaded back.
+
+        Args:
+            data (np.ndarray): The terrain data to interpolate.
+
+        Returns:
+            np.ndarray: The interpolated terrain data.
+        """
+
+        if self.cp is None:
+            self.initialize()
+
+        pad_x = int(self.settings.source_padding * self.settings.fx)
+        pad_y = int(self.settings.source_padding * self.settings.fy)
+        with self.stream:
+            d_data = self.cp.asarray(data, dtype=self.cp.float32)
+            d_out = self.ndimage.zoom(
+                d_data,
+                (self.settings.fy, self.settings.fx),
+                order=self.order,
+                mode="nearest",
+                grid_mode=True,
+            )
+            crop = d_out[pad_y : d_out.shape[0] - pad_y, pad_x : d_out.shape[1] - pad_x]
+            out = self.cp.asnumpy(crop, stream=self.stream)
+            self.stream.synchronize()
+        return out
+
+
+class SharedNDArrayPool:
+    """
+    A pool of shared memory slots used to exchange numpy arrays between processes.
+    Instead of pickling the arrays through the queues, the arrays are written once
+    into a shared memory slot, and only the index of that slot (and the shape of the
+    array) goes through the queues. Free slots are recycled through a queue of indices,
+    which also bounds the number of arrays in flight.
+    """
+
+    def __init__(
+        self,
+        num_slots: int,
+        slot_shape: Tuple[int, int],
+        dtype: np.dtype = np.float32,
+        mp_context: multiprocessing.context.BaseContext = None,
+    ) -> None:
+        """
+        Args:
+            num_slots (int): The number of slots in the pool.
+            slot_shape (Tuple[int, int]): The largest array shape a slot must be able to hold.
+            dtype (np.dtype): The data type of the arrays stored in the pool.
+            mp_context (multiprocessing.context.BaseContext): The context of the processes sharing
+                the pool. If None, the default context is used.
+        """
+
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+
+        self.num_slots = num_slots
+        self.dtype = np.dtype(dtype)
+        self.slot_size = int(np.prod(slot_shape))
+        self.shms = [
+            shared_memory.SharedMemory(create=True, size=self.slot_size * self.dtype.itemsize) for _ in range(num_slots)
+        ]
+        self.free_slots = mp_context.Queue(maxsize=num_slots)
+        for i in range(num_slots):
+            self.free_slots.put(i)
+
+    def get_view(self, slot: int, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Returns a numpy array backed by the memory of the given slot.
+        The view must not be pickled: it would be copied and lose its link to the slot.
+
+        Args:
+            slot (int): The index of the slot.
+            shape (Tuple[int, int]): The shape of the array stored in the slot.
+
+        Returns:
+            np.ndarray: A view on the slot.
+        """
+
+        return np.ndarray(shape, dtype=self.dtype, buffer=self.shms[slot].buf)
+
+    def write(
+        self, data: np.ndarray, timeout: float = None, stop_event: multiprocessing.Event = None
+    ) -> Tuple[int, Tuple[int, int]]:
+        """
+        Writes the data into a free slot. Blocks until a slot is available. If a stop event
+        is given, the wait is given up as soon as the event is set, such that a worker does
+        not hang on a full pool once nobody reads it anymore.
+
+        Args:
+            data (np.ndarray): The data to write.
+            timeout (float): The maximum time to wait for a free slot. If None, waits forever. (seconds)
+            stop_event (multiprocessing.Event): The event that interrupts the wait when set.
+
+        Returns:
+            Tuple[int, Tuple[int, int]]: The index of the slot and the shape of the data.
+
+        Raises:
+            queue.Empty: If no slot became available in time, or if the stop event was set.
+        """
+
+        assert data.size <= self.slot_size, "Data is too large for the shared memory slots."
+        if stop_event is None:
+            slot = self.free_slots.get(timeout=timeout)
+        else:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                wait = 0.1 if deadline is None else min(0.1, max(deadline - time.time(), 0.0))
+                try:
+                    slot = self.free_slots.get(timeout=wait)
+                    break
+                except queue.Empty:
+                    if stop_event.is_set() or ((deadline is not None) and (time.time() >= deadline)):
+                        raise
+        self.get_view(slot, data.shape)[:] = data
+        return slot, data.shape
+
+    def read(self, slot: int, shape: Tuple[int, int], out: np.ndarray = None) -> np.ndarray:
+        """
+        Copies the data out of the given slot and releases it.
+
+        Args:
+            slot (int): The index of the slot.
+            shape (Tuple[int, int]): The shape of the array stored in the slot.
+            out (np.ndarray): Optional array to copy the data into.
+
+        Returns:
+            np.ndarray: A copy of the data stored in the slot.
+        """
+
+        if out is None:
+            data = self.get_view(slot, shape).copy()
+        else:
+            np.copyto(out, self.get_view(slot, shape))
+            data = out
+        self.release(slot)
+        return data
+
+    def release(self, slot: int) -> None:
+        """
+        Gives the slot back to the pool.
+
+        Args:
+            slot (int): The index of the slot.
+        """
+
+        self.free_slots.put(slot)
+
+    def close(self) -> None:
+        """
+        Closes and unlinks the shared memory slots. Must only be called by the process
+        that created the pool, once the workers are done.
+        """
+
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+        self.free_slots.close()
+        self.free_slots.cancel_join_thread()
+
+
+class SharedRing:
+    """
+    A ring buffer of records stored in shared memory, used to send structured arrays to
+    other processes. A single process pushes the records, and only the position of the
+    records in the ring goes through the queues. Any process can then read the records.
+
+    The records may be read in any order. Hence, each slot has a flag that the reader sets
+    once it has copied the record. The slots are only reused once all the slots before
+    them have been read.
+    """
+
+    def __init__(self, num_slots: int, record_dtype: np.dtype) -> None:
+        """
+        Args:
+            num_slots (int): The number of records the ring can hold.
+            record_dtype (np.dtype): The data type of the records.
+        """
+
+        self.num_slots = num_slots
+        self.dtype = np.dtype(record_dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * (self.dtype.itemsize + 1))
+        self.records = np.ndarray((num_slots,), dtype=self.dtype, buffer=self.shm.buf)
+        self.is_read = np.ndarray(
+            (num_slots,), dtype=np.uint8, buffer=self.shm.buf, offset=num_slots * self.dtype.itemsize
+        )
+        self.is_read[:] = 0
+        # Number of records pushed, and number of slots reclaimed. Only used by the process pushing the records.
+        self.head = 0
+        self.tail = 0
+
+    def get_slots(self, start: int, count: int) -> np.ndarray:
+        """
+        Returns the slots of the given records.
+
+        Args:
+            start (int): The position of the first record.
+            count (int): The number of records.
+
+        Returns:
+            np.ndarray: The indices of the slots. (count,) int64.
+        """
+
+        return (start + np.arange(count)) % self.num_slots
+
+    def reclaim(self) -> None:
+        """
+        Reclaims the slots that have been read, up to the first slot that has not been read yet.
+        """
+
+        slots = self.get_slots(self.tail, self.head - self.tail)
+        is_read = self.is_read[slots]
+        count = len(slots) if is_read.all() else int(np.argmin(is_read))
+        self.is_read[slots[:count]] = 0
+        self.tail += count
+
+    def push(self, records: np.ndarray) -> int:
+        """
+        Writes the records into the ring. Does not block if there is not enough room.
+
+        Args:
+            records (np.ndarray): The records to write. (N,)
+
+        Returns:
+            int: The position of the first record, or -1 if there is not enough room in the ring.
+        """
+
+        count = len(records)
+        if self.head - self.tail + count > self.num_slots:
+            self.reclaim()
+            if self.head - self.tail + count > self.num_slots:
+                return -1
+        start = self.head % self.num_slots
+        end = min(start + count, self.num_slots)
+        self.records[start:end] = records[: end - start]
+        self.records[: count - (end - start)] = records[end - start :]
+        position = self.head
+        self.head += count
+        return position
+
+    def read(self, start: int, count: int) -> np.ndarray:
+        """
+        Copies the records out of the ring and marks their slots as read.
+
+        Args:
+            start (int): The position of the first record.
+            count (int): The number of records.
+
+        Returns:
+            np.ndarray: A copy of the records. (count,)
+        """
+
+        slots = self.get_slots(start, count)
+        records = self.records[slots]
+        self.is_read[slots] = 1
+        return records
+
+    def close(self) -> None:
+        """
+        Closes and unlinks the shared memory. Must only be called by the process that
+        created the ring, once the other processes are done.
+        """
+
+        # The views must be released before the shared memory can be closed.
+        self.records = None
+        self.is_read = None
+        self.shm.close()
+        self.shm.unlink()
+
+
 @dataclasses.dataclass
 class WorkerManagerConf:
     """
@@ -211,8 +602,11 @@ class BaseWorkerManager:
     """
     BaseWorkerManager class. This class is used to manage the worker processes.
     It is responsible for distributing the work across the workers and collecting the results.
-    It ensures that the workers are running and that the work is distributed in a balanced way.
-    I.e. the workers have a similar load.
+    By default, all the workers pull their jobs from a single shared input queue. Hence, the
+    load is balanced by the workers themselves: an idle worker takes the next job as soon as
+    it is available, and dispatching a job costs a single put regardless of the number of
+    workers. Subclasses can override this: the CraterBuilderManager gives each worker its
+    own input queue and lets idle workers steal jobs from the other queues.
     """
 
     def __init__(
@@ -221,6 +615,9 @@ class BaseWorkerManager:
         worker_class=None,
         parent_thread: threading.Thread = None,
         thread_timeout: float = 1.0,
+        output_pool: SharedNDArrayPool = None,
+        progress_event: multiprocessing.Event = None,
+        mp_context: multiprocessing.context.BaseContext = None,
         **kwargs,
     ):
         """
@@ -229,23 +626,53 @@ class BaseWorkerManager:
             worker_class (BaseWorker): The worker class to use.
             parent_thread (threading.Thread): The parent thread.
             thread_timeout (float): The timeout for the worker thread. (seconds)
+            output_pool (SharedNDArrayPool): The shared memory pool the workers write their results to.
+                If None, the results are sent through the output queue directly.
+            progress_event (multiprocessing.Event): The event the workers set each time they output
+                a result. It can be shared between managers. If None, a new event is created.
+            mp_context (multiprocessing.context.BaseContext): The context used to start the workers
+                and to create the objects they share with the manager. If None, the default context
+                is used.
             **kwargs: Additional arguments.
         """
 
-        self.manager = multiprocessing.Manager()
-        # Create the input and output queues
-        self.input_queue = self.manager.Queue(maxsize=settings.input_queue_size)
-        self.output_queue = self.manager.Queue(maxsize=settings.output_queue_size)
-
         # Create the workers
+        self.mp_context = multiprocessing.get_context() if mp_context is None else mp_context
         self.num_workers = settings.num_workers
+        self.instantiate_queues(settings)
         self.worker_class = worker_class
         self.parent_thread = parent_thread
         self.thread_timeout = thread_timeout
+        self.output_pool = output_pool
+        if output_pool is not None:
+            kwargs["output_pool"] = output_pool
+        # Lets the consumers wait for the results instead of polling the output queue.
+        if progress_event is None:
+            progress_event = self.mp_context.Event()
+        self.progress_event = progress_event
+        kwargs["progress_event"] = progress_event
+        # Set on shutdown, such that the workers stop waiting for room in the output pool.
+        self.stop_event = self.mp_context.Event()
+        kwargs["stop_event"] = self.stop_event
         self.kwargs = kwargs
+        self.is_shutdown = False
+        # Number of results that are expected but have not been collected yet.
+        self.num_pending = 0
 
         self.instantiate_workers(**kwargs)
 
+    def instantiate_queues(self, settings: WorkerManagerConf) -> None:
+        """
+        Instantiates the input and output queues. The workers are given the queues directly, the
+        messages go through a pipe between the processes, without a manager process in between.
+
+        Args:
+            settings (WorkerManagerConf): The settings for the worker manager.
+        """
+
+        self.input_queue = self.mp_context.Queue(maxsize=settings.input_queue_size)
+        self.output_queue = self.mp_context.Queue(maxsize=settings.output_queue_size)
+
     def instantiate_workers(
         self,
         **kwargs,
@@ -257,10 +684,13 @@ class BaseWorkerManager:
             **kwargs: Additional arguments. Used to pass the objects the workers need.
         """
 
+        # When the workers are forked, each process inherits a copy-on-write view of the worker
+        # instance, and of the objects it references. There is no need to copy them. When they
+        # are spawned, the worker instance is pickled once per process instead.
         worker_instance = self.worker_class(self.thread_timeout, **kwargs)
 
         self.workers = [
-            multiprocessing.Process(target=worker_instance.run, args=(self.input_queue, self.output_queue))
+            self.mp_context.Process(target=worker_instance.run, args=(self.input_queue, self.output_queue))
             for _ in range(self.num_workers)
         ]
         for worker in self.workers:
@@ -337,6 +767,17 @@ class BaseWorkerManager:
 
         return self.is_input_queue_empty() and self.is_output_queue_empty()
 
+    def is_fully_drained(self) -> bool:
+        """
+        Checks if the results of all the jobs sent to the workers have been collected.
+        Unlike are_workers_done, this accounts for the jobs being processed by the workers.
+
+        Returns:
+            bool: True if all the results have been collected, False otherwise.
+        """
+
+        return self.num_pending == 0
+
     def process_data(self, coords: Tuple[float, float], data) -> None:
         """
         Processes the data by adding it to the worker manager's input queue.
@@ -347,46 +788,165 @@ class BaseWorkerManager:
         """
 
         self.input_queue.put((coords, data))
+        self.num_pending += 1
 
-    def collect_results(self) -> List[Tuple[Tuple[float, float], np.ndarray]]:
+    def drain_output_queue(self, max_items: int = None) -> List[Tuple[Tuple[float, float], object]]:
         """
-        Collects the results from the workers.
+        Takes the items currently in the output queue. If the workers write their
+        results to shared memory, the items hold the shared memory slots of the results.
+        The content of an item is None if the workers failed to process its block.
+
+        Args:
+            max_items (int): The maximum number of items to take. If None, all the items are taken.
 
         Returns:
-            List[Tuple[Tuple[float, float], np.ndarray]]: A list of tuples with the
-            coordinates and the data.
+            List[Tuple[Tuple[float, float], object]]: A list of tuples with the
+            coordinates and the content of the queue.
         """
 
         results = []
 
         has_items = True
-        while has_items:
+        while has_items and ((max_items is None) or (len(results) < max_items)):
             try:
                 results.append(self.output_queue.get_nowait())
             except:
                 has_items = False
+        self.num_pending -= len(results)
+        for coords, content in results:
+            if content is None:
+                logger.error("The workers failed to process the block %s, it is left empty.", coords)
         return results
 
-    def shutdown(self) -> None:
+    def collect_results(self, max_items: int = None) -> List[Tuple[Tuple[float, float], np.ndarray]]:
         """
-        Shuts down the worker manager and its workers.
+        Collects the results from the workers.
+
+        Args:
+            max_items (int): The maximum number of results to collect. If None, all the results are collected.
+
+        Returns:
+            List[Tuple[Tuple[float, float], np.ndarray]]: A list of tuples with the
+            coordinates and the data. The data is None if the workers failed to process the block.
+        """
+
+        results = self.drain_output_queue(max_items)
+        if self.output_pool is not None:
+            results = [(coords, None if slot is None else self.output_pool.read(*slot)) for coords, slot in results]
+        return results
+
+    def collect_stacked_results(
+        self, shape: Tuple[int, int], max_items: int = None
+    ) -> Tuple[List[Tuple[float, float]], np.ndarray]:
+        """
+        Collects the results from the workers into a single contiguous array.
+        All the results must have the same shape. The results of the blocks the
+        workers failed to process are filled with zeros.
+
+        Args:
+            shape (Tuple[int, int]): The shape of the results.
+            max_items (int): The maximum number of results to collect. If None, all the results are collected.
+
+        Returns:
+            Tuple[List[Tuple[float, float]], np.ndarray]: The coordinates of the results, and
+            the results stacked along the first axis.
+        """
+
+        if self.output_pool is None:
+            results = self.collect_results(max_items)
+            stack = np.empty((len(results),) + tuple(shape), dtype=np.float32)
+            for i, (_, data) in enumerate(results):
+                stack[i] = 0 if data is None else data
+            return [coords for coords, _ in results], stack
+
+        results = self.drain_output_queue(max_items)
+        stack = np.empty((len(results),) + tuple(shape), dtype=self.output_pool.dtype)
+        for i, (_, slot) in enumerate(results):
+            if slot is None:
+                stack[i] = 0
+            else:
+                self.output_pool.read(*slot, out=stack[i])
+        return [coords for coords, _ in results], stack
+
+    def drain_input_queue(self) -> List[Tuple[Tuple[float, float], object]]:
+        """
+        Takes all the jobs currently in the input queue, such that the workers do not
+        process them.
+
+        Returns:
+            List[Tuple[Tuple[float, float], object]]: A list of tuples with the
+            coordinates and the content of the queue.
+        """
+
+        jobs = []
+
+        has_items = True
+        while has_items:
+            try:
+                jobs.append(self.input_queue.get_nowait())
+            except:
+                has_items = False
+        return jobs
+
+    def shutdown(self, timeout: float = 5.0) -> None:
         """
+        Shuts down the worker manager and its workers. The pending jobs are discarded and
+        a stop signal is sent to every worker. The workers that are not done within the
+        timeout are terminated. Then, the queues and the shared memory are released.
+        Calling this function more than once has no effect.
 
+        Args:
+            timeout (float): The time given to the workers to finish their current job. (seconds)
+        """
+
+        if self.is_shutdown:
+            return
+        self.is_shutdown = True
+
+        # Discarding the pending jobs ensures the stop signals can be queued.
+        self.stop_event.set()
+        self.drain_input_queue()
+        self.send_stop_signals()
+        deadline = time.time() + timeout
         for worker in self.workers:
-            self.input_queue.put(((0, 0), None))
+            # A worker cannot exit while its results are still waiting to be written to the
+            # output queue. Hence, the output queue is emptied while waiting for the workers,
+            # and the slots of the discarded results are given back to the pool.
+            while worker.is_alive() and (time.time() < deadline):
+                for _, content in self.drain_output_queue():
+                    if (self.output_pool is not None) and (content is not None):
+                        self.output_pool.release(content[0])
+                worker.join(timeout=0.1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.close()
+
+    def send_stop_signals(self) -> None:
+        """
+        Sends a stop signal to every worker.
+        """
+
         for worker in self.workers:
-            worker.join()
+            self.input_queue.put(((0, 0), None))
 
-    def __del__(self) -> None:
+    def close(self) -> None:
         """
-        Destructor.
+        Releases the queues and the shared memory used to communicate with the workers.
+        Must only be called once the workers are done.
         """
 
-        # Try except to avoid multiple calls to shutdown
-        try:
-            self.shutdown()
-        except Exception as e:
-            pass
+        for q in (self.input_queue, self.output_queue):
+            q.close()
+            q.cancel_join_thread()
+        if self.output_pool is not None:
+            self.output_pool.close()
+
+    def __enter__(self) -> "BaseWorkerManager":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.shutdown()
 
 
 class CraterBuilderWorker:
@@ -398,43 +958,114 @@ class CraterBuilderWorker:
         self,
         thread_timeout: float = 1.0,
         builder: CraterBuilder = None,
+        output_pool: SharedNDArrayPool = None,
+        input_ring: SharedRing = None,
+        progress_event: multiprocessing.Event = None,
+        stop_event: multiprocessing.Event = None,
+        steal_timeout: float = 0.05,
     ) -> None:
         """
         Args:
             thread_timeout (float): The timeout for the worker thread. (seconds)
             builder (CraterBuilder): The crater builder.
+            output_pool (SharedNDArrayPool): The shared memory pool holding the generated craters.
+            input_ring (SharedRing): The shared memory ring holding the craters metadata.
+            progress_event (multiprocessing.Event): The event set each time a result is output.
+            stop_event (multiprocessing.Event): The event set when the workers must stop.
+            steal_timeout (float): How long an idle worker waits on its own queue before
+                trying to steal jobs from the other workers again. (seconds)
         """
 
         self.thread_timeout = thread_timeout
-        self.builder = copy.copy(builder)
+        self.builder = builder
+        self.output_pool = output_pool
+        self.input_ring = input_ring
+        self.progress_event = progress_event
+        self.stop_event = stop_event
+        self.steal_timeout = steal_timeout
+
+    def get_job(self, input_queues: List[multiprocessing.Queue], worker_id: int) -> Tuple[List, object, np.ndarray]:
+        """
+        Takes the next job. The worker first looks at its own queue, then steals from the
+        queues of the other workers. If all the queues are empty, it waits on its own queue
+        for a short time.
+
+        Args:
+            input_queues (List[multiprocessing.Queue]): The input queues of all the workers.
+            worker_id (int): The index of the queue of this worker.
 
-    def run(self, input_queue: multiprocessing.Queue, output_queue: multiprocessing.Queue) -> None:
+        Returns:
+            Tuple[List, object, np.ndarray]: The coordinates of the blocks, the position of their
+            craters metadata in the input ring (or the craters metadata themselves), and the number
+            of craters of each block. None if no job was available.
+        """
+
+        num_queues = len(input_queues)
+        for k in range(num_queues):
+            try:
+                return input_queues[(worker_id + k) % num_queues].get_nowait()
+            except queue.Empty:
+                pass
+        try:
+            return input_queues[worker_id].get(timeout=self.steal_timeout)
+        except queue.Empty:
+            return None
+
+    def run(
+        self,
+        input_queues: List[multiprocessing.Queue],
+        output_queue: multiprocessing.Queue,
+        worker_id: int,
+    ) -> None:
         """
         The main function of the worker process.
         This function is called when the worker process is started.
-        It takes craters metadata and coordinates from the input queue
-        and generates images with inprinted craters.
+        It takes batches of craters metadata and coordinates from the input queues
+        and generates images with inprinted craters. The craters metadata are read
+        from the input ring. The images are written to shared memory, only their
+        slot is sent through the output queue. If a block cannot be generated, the
+        error is logged and None is sent instead of its slot, such that the manager
+        does not wait for it.
 
         Args:
-            input_queue (multiprocessing.JoinableQueue): The input queue.
-            output_queue (multiprocessing.JoinableQueue): The output queue.
+            input_queues (List[multiprocessing.Queue]): The input queues of all the workers.
+            output_queue (multiprocessing.Queue): The output queue.
+            worker_id (int): The index of the queue of this worker.
         """
 
         while True:
+            job = self.get_job(input_queues, worker_id)
+            if job is None:
+                continue
+            coords_batch, records, counts = job
+            if counts is None:
+                break
             try:
-                coords, crater_meta_data = input_queue.get(timeout=self.thread_timeout)
-                if crater_meta_data is None:
+                if not isinstance(records, np.ndarray):
+                    records = self.input_ring.read(records, int(np.sum(counts)))
+                blocks = np.split(records, np.cumsum(counts)[:-1])
+            except Exception:
+                logger.exception("Failed to read the craters metadata of the blocks %s.", coords_batch)
+                blocks = [None] * len(coords_batch)
+            for coords, crater_meta_data in zip(coords_batch, blocks):
+                try:
+                    slot = None
+                    if crater_meta_data is not None:
+                        data = self.builder.generate_craters(crater_meta_data, coords)
+                        slot = self.output_pool.write(data, stop_event=self.stop_event)
+                except queue.Empty:
+                    # The workers are stopping, the rest of the job is discarded.
                     break
+                except Exception:
+                    logger.exception("Failed to generate the craters of the block %s.", coords)
                 data_not_in_queue = True
-                out = (coords, self.builder.generate_craters(crater_meta_data, coords))
                 while data_not_in_queue:
                     try:
-                        output_queue.put(out, timeout=0.1)
+                        output_queue.put((coords, slot), timeout=0.1)
                         data_not_in_queue = False
-                    except Exception as e:
+                    except queue.Full:
                         pass
-            except Exception as e:
-                pass
+                self.progress_event.set()
         print("crater worker dead.")
 
 
@@ -443,6 +1074,16 @@ class CraterBuilderManager(BaseWorkerManager):
     CraterBuilderManager class. This class is responsible for managing the crater
     builder workers. It is responsible for distributing the work across the workers
     and collecting the results.
+
+    Unlike the other managers, each worker has its own input queue. The jobs are
+    distributed in a round-robin fashion, and idle workers steal jobs from the
+    queues of the other workers. Hence, the workers do not all contend for the
+    lock of a single queue.
+
+    The craters metadata are packed in structured arrays and written to a ring in
+    shared memory, such that they are not pickled. The queues only carry their
+    position in the ring. If the ring is full, the structured arrays are sent
+    through the queues instead.
     """
 
     def __init__(
@@ -451,6 +1092,9 @@ class CraterBuilderManager(BaseWorkerManager):
         parent_thread: threading.Thread = None,
         thread_timeout: float = 1.0,
         builder: CraterBuilder = None,
+        batch_size: int = 32,
+        ring_size: int = 2**18,
+        progress_event: multiprocessing.Event = None,
     ) -> None:
         """
         Args:
@@ -458,16 +1102,196 @@ class CraterBuilderManager(BaseWorkerManager):
             parent_thread (threading.Thread): The parent thread.
             thread_timeout (float): The timeout for the worker thread. (seconds)
             builder (CraterBuilder): The crater builder.
+            batch_size (int): The maximum number of blocks sent to a worker in a single job.
+            ring_size (int): The number of craters metadata the input ring can hold.
+            progress_event (multiprocessing.Event): The event the workers set each time they output
+                a result. If None, a new event is created.
         """
 
+        self.batch_size = batch_size
+
+        # The generated craters are exchanged through shared memory, the queues only carry slot indices.
+        block_size = int(builder.settings.block_size / builder.settings.resolution)
+        output_pool = SharedNDArrayPool(settings.output_queue_size + settings.num_workers, (block_size, block_size))
+        self.input_ring = SharedRing(ring_size, CRATER_METADATA_DTYPE)
+
         super().__init__(
             settings=settings,
             worker_class=CraterBuilderWorker,
             builder=builder,
+            input_ring=self.input_ring,
             parent_thread=parent_thread,
             thread_timeout=thread_timeout,
+            output_pool=output_pool,
+            progress_event=progress_event,
         )
 
+    def process_data(self, coords: Tuple[float, float], data: np.ndarray) -> None:
+        """
+        Processes the data of a single block by adding it to the worker manager's input queue.
+
+        Args:
+            coords (Tuple[float, float]): The coordinates of the block.
+            data (np.ndarray): The craters metadata of the block. (N,) CRATER_METADATA_DTYPE.
+        """
+
+        self.submit(([coords], [data]))
+        self.num_pending += 1
+
+    def process_data_batch(self, coords: List[Tuple[float, float]], data: List[np.ndarray]) -> None:
+        """
+        Processes the data of multiple blocks. The blocks are grouped in jobs of up to
+        batch_size blocks, such that a single message is sent per job. The jobs are
+        made smaller when there are too few blocks to give a job to every worker.
+
+        Args:
+            coords (List[Tuple[float, float]]): The coordinates of the blocks.
+            data (List[np.ndarray]): The craters metadata of the blocks. (N,) CRATER_METADATA_DTYPE each.
+        """
+
+        job_size = max(1, min(self.batch_size, math.ceil(len(coords) / self.num_workers)))
+        for i in range(0, len(coords), job_size):
+            self.submit((coords[i : i + job_size], data[i : i + job_size]))
+        self.num_pending += len(coords)
+
+    def submit(self, job: Tuple[List, List]) -> None:
+        """
+        Adds a job to the input queue of the next worker. If that queue is full, the job
+        goes to the next queue that is not full. If all the queues are full, this waits
+        until the queue of the next worker has some room. The craters metadata of the job
+        are concatenated and written to the input ring first.
+
+        Args:
+            job (Tuple[List, List]): The coordinates and the craters metadata of the blocks.
+                The craters metadata of each block are a (N,) CRATER_METADATA_DTYPE array.
+        """
+
+        coords, craters = job
+        counts = np.array([len(block_craters) for block_craters in craters], dtype=np.int64)
+        records = np.concatenate(craters) if craters else np.empty(0, dtype=CRATER_METADATA_DTYPE)
+        start = self.input_ring.push(records)
+        job = (coords, records if start < 0 else start, counts)
+
+        for k in range(self.num_workers):
+            try:
+                self.input_queues[(self.next_queue + k) % self.num_workers].put_nowait(job)
+                break
+            except queue.Full:
+                pass
+        else:
+            self.input_queues[self.next_queue].put(job)
+        self.next_queue = (self.next_queue + 1) % self.num_workers
+
+    def instantiate_queues(self, settings: WorkerManagerConf) -> None:
+        """
+        Instantiates one input queue per worker, and the output queue.
+        The input queues share the capacity given in the settings.
+
+        Args:
+            settings (WorkerManagerConf): The settings for the worker manager.
+        """
+
+        queue_size = max(1, settings.input_queue_size // settings.num_workers)
+        self.input_queues = [self.mp_context.Queue(maxsize=queue_size) for _ in range(settings.num_workers)]
+        self.next_queue = 0
+        self.output_queue = self.mp_context.Queue(maxsize=settings.output_queue_size)
+
+    def instantiate_workers(
+        self,
+        **kwargs,
+    ) -> None:
+        """
+        Instantiates the worker processes. Each worker is given the input queues of
+        all the workers, and the index of its own queue.
+
+        Args:
+            **kwargs: Additional arguments. Used to pass the objects the workers need.
+        """
+
+        worker_instance = self.worker_class(self.thread_timeout, **kwargs)
+
+        self.workers = [
+            self.mp_context.Process(target=worker_instance.run, args=(self.input_queues, self.output_queue, i))
+            for i in range(self.num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def get_input_queue_length(self) -> int:
+        """
+        Returns the total length of the input queues.
+
+        Returns:
+            int: The length of the input queues.
+        """
+
+        return sum(q.qsize() for q in self.input_queues)
+
+    def is_input_queue_empty(self) -> bool:
+        """
+        Checks if all the input queues are empty.
+
+        Returns:
+            bool: True if the input queues are empty, False otherwise.
+        """
+
+        return all(q.empty() for q in self.input_queues)
+
+    def is_input_queue_full(self) -> bool:
+        """
+        Checks if all the input queues are full.
+
+        Returns:
+            bool: True if the input queues are full, False otherwise.
+        """
+
+        return all(q.full() for q in self.input_queues)
+
+    def drain_input_queue(self) -> List[Tuple[List, List]]:
+        """
+        Takes all the jobs currently in the input queues, such that the workers do not
+        process them. Their craters metadata are read back from the input ring.
+
+        Returns:
+            List[Tuple[List, List]]: A list of jobs, with the coordinates and the craters
+            metadata of their blocks.
+        """
+
+        jobs = []
+        for q in self.input_queues:
+            has_items = True
+            while has_items:
+                try:
+                    coords, records, counts = q.get_nowait()
+                except queue.Empty:
+                    has_items = False
+                    continue
+                if not isinstance(records, np.ndarray):
+                    records = self.input_ring.read(records, int(np.sum(counts)))
+                jobs.append((coords, np.split(records, np.cumsum(counts)[:-1])))
+        return jobs
+
+    def send_stop_signals(self) -> None:
+        """
+        Sends a stop signal to every worker. A worker may take the stop signal of another
+        worker, but it exits right after, hence every worker takes exactly one stop signal.
+        """
+
+        for q in self.input_queues:
+            q.put(([(0, 0)], None, None))
+
+    def close(self) -> None:
+        """
+        Releases the queues and the shared memory used to communicate with the workers.
+        Must only be called once the workers are done.
+        """
+
+        for q in self.input_queues + [self.output_queue]:
+            q.close()
+            q.cancel_join_thread()
+        self.output_pool.close()
+        self.input_ring.close()
+
 
 class BicubicInterpolatorWorker:
     """
@@ -479,15 +1303,30 @@ class BicubicInterpolatorWorker:
         self,
         thread_timeout: float = 1.0,
         interp: Interpolator = None,
+        input_pool: SharedNDArrayPool = None,
+        output_pool: SharedNDArrayPool = None,
+        num_cv2_threads: int = 1,
+        progress_event: multiprocessing.Event = None,
+        stop_event: multiprocessing.Event = None,
     ):
         """
         Args:
             thead_timeout (float): The timeout for the worker thread. (seconds)
             interp (Interpolator): The interpolator.
+            input_pool (SharedNDArrayPool): The shared memory pool holding the terrain data to interpolate.
+            output_pool (SharedNDArrayPool): The shared memory pool holding the interpolated terrain data.
+            num_cv2_threads (int): The number of threads cv2 can use in the worker process.
+            progress_event (multiprocessing.Event): The event set each time a result is output.
+            stop_event (multiprocessing.Event): The event set when the workers must stop.
         """
 
-        self.interpolator = copy.copy(interp)
+        self.interpolator = interp
         self.thread_timeout = thread_timeout
+        self.input_pool = input_pool
+        self.output_pool = output_pool
+        self.num_cv2_threads = num_cv2_threads
+        self.progress_event = progress_event
+        self.stop_event = stop_event
 
     def run(
         self,
@@ -498,27 +1337,42 @@ class BicubicInterpolatorWorker:
         The main function of the worker process.
         This function is called when the worker process is started.
         It takes terrain data from the input queue and interpolates it.
+        The queues only carry the shared memory slots in which the data is stored.
+        If a block cannot be interpolated, the error is logged and None is sent
+        instead of its slot, such that the manager does not wait for it.
 
         Args:
             input_queue (multiprocessing.JoinableQueue): The input queue.
             output_queue (multiprocessing.JoinableQueue): The output queue.
         """
 
+        # The cv2 settings are process wide, they must be set inside the worker process.
+        cv2.setNumThreads(self.num_cv2_threads)
+        cv2.setUseOptimized(True)
         while True:
             try:
                 coords, data = input_queue.get(timeout=self.thread_timeout)
-                if data is None:
-                    break
-                out = (coords, self.interpolator.interpolate(data))
-                data_not_in_queue = True
-                while data_not_in_queue:
-                    try:
-                        output_queue.put(out, timeout=0.1)
-                        data_not_in_queue = False
-                    except Exception as e:
-                        pass
-            except Exception as e:
-                pass
+            except queue.Empty:
+                continue
+            if data is None:
+                break
+            try:
+                slot = None
+                data = self.input_pool.read(*data)
+                slot = self.output_pool.write(self.interpolator.interpolate(data), stop_event=self.stop_event)
+            except queue.Empty:
+                # The workers are stopping, the block is discarded.
+                continue
+            except Exception:
+                logger.exception("Failed to interpolate the block %s.", coords)
+            data_not_in_queue = True
+            while data_not_in_queue:
+                try:
+                    output_queue.put((coords, slot), timeout=0.1)
+                    data_not_in_queue = False
+                except queue.Full:
+                    pass
+            self.progress_event.set()
         print("bicubic worker dead.")
 
 
@@ -527,33 +1381,81 @@ class BicubicInterpolatorManager(BaseWorkerManager):
     BicubicInterpolatorManager class. This class is responsible for managing the
     bicubic interpolator workers. It is responsible for distributing the work across
     the workers and collecting the results.
+
+    The workers share the single input queue of the BaseWorkerManager.
     """
 
     def __init__(
         self,
         settings: WorkerManagerConf = WorkerManagerConf(),
         interp: Interpolator = None,
-        num_cv2_threads: int = 4,
+        source_shape: Tuple[int, int] = (0, 0),
+        num_cv2_threads: int = 1,
         parent_thread: threading.Thread = None,
         thread_timeout: float = 1.0,
+        progress_event: multiprocessing.Event = None,
     ):
         """
         Args:
             settings (WorkerManagerCfg): The settings for the worker manager.
             interp (Interpolator): The interpolator.
-            num_cv2_threads (int): The number of threads to use for cv2.
+            source_shape (Tuple[int, int]): The largest shape of the terrain data sent to the workers. (pixels)
+            num_cv2_threads (int): The number of threads each worker lets cv2 use. Keeping
+                num_workers * num_cv2_threads below the number of cores avoids oversubscription.
             parent_thread (threading.Thread): The parent thread.
             thread_timeout (float): The timeout for the worker thread. (seconds
+            progress_event (multiprocessing.Event): The event the workers set each time they output
+                a result. If None, a new event is created.
         """
 
+        # The workers are started with the method required by the interpolator.
+        mp_context = multiprocessing.get_context(interp.start_method)
+        # The terrain data is exchanged through shared memory, the queues only carry slot indices.
+        target_shape = (
+            int(np.ceil(source_shape[0] * interp.settings.fx)),
+            int(np.ceil(source_shape[1] * interp.settings.fy)),
+        )
+        self.input_pool = SharedNDArrayPool(
+            settings.input_queue_size + settings.num_workers, source_shape, mp_context=mp_context
+        )
+        output_pool = SharedNDArrayPool(
+            settings.output_queue_size + settings.num_workers, target_shape, mp_context=mp_context
+        )
+
         super().__init__(
             settings=settings,
             worker_class=BicubicInterpolatorWorker,
             interp=interp,
+            input_pool=self.input_pool,
+            output_pool=output_pool,
+            num_cv2_threads=num_cv2_threads,
             parent_thread=parent_thread,
             thread_timeout=thread_timeout,
+            progress_event=progress_event,
+            mp_context=mp_context,
         )
-        cv2.setNumThreads(num_cv2_threads)
+
+    def process_data(self, coords: Tuple[float, float], data: np.ndarray) -> None:
+        """
+        Processes the data by writing it to shared memory and adding the slot to the
+        worker manager's input queue.
+
+        Args:
+            coords (Tuple[float, float]): The coordinates of the data.
+            data (np.ndarray): The terrain data to interpolate.
+        """
+
+        self.input_queue.put((coords, self.input_pool.write(data)))
+        self.num_pending += 1
+
+    def close(self) -> None:
+        """
+        Releases the queues and the shared memory used to communicate with the workers.
+        Must only be called once the workers are done.
+        """
+
+        super().close()
+        self.input_pool.close()
 
 
 class ThreadMonitor:
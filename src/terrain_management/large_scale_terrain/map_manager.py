@@ -71,11 +71,23 @@ class MapManager:
         self.hr_dem_settings = map_manager_settings.hrdem_settings
         self.settings = map_manager_settings
         self.lr_dem = None
+        self.hr_dem_gen = None
 
         self.fetch_pregenerated_lr_dems()
 
     def load(self, path: str) -> np.ndarray:
-        map = np.load(path)
+        """
+        Loads a low resolution DEM. The DEM is memory mapped, such that it is not read
+        in its entirety, the pages are read from the disk as the DEM is accessed.
+
+        Args:
+            path (str): path to the DEM.
+
+        Returns:
+            np.ndarray: the DEM, a read-only view on the memory mapped file.
+        """
+
+        map = np.load(path, mmap_mode="r")
         return np.flip(map.T, axis=1)
 
     def fetch_pregenerated_lr_dems(self) -> None:
@@ -124,6 +136,17 @@ class MapManager:
             else:
                 warnings.warn(f"Folder {folder} is not a directory.")
 
+    def build_hr_dem_gen(self) -> None:
+        """
+        Instantiates the high resolution DEM generator for the current low resolution DEM.
+        If a generator already exists, it is shut down first, such that its workers and
+        shared memory are released before new ones are created.
+        """
+
+        if self.hr_dem_gen is not None:
+            self.hr_dem_gen.shutdown()
+        self.hr_dem_gen = HighResDEMGen(self.lr_dem, self.hr_dem_settings)
+
     def load_lr_dem_by_name(self, name: str) -> None:
         """
         Loads the low resolution DEM by name, and initializes the high resolution DEM generator.
@@ -145,7 +168,7 @@ class MapManager:
         lr_dem_res = self.lr_dem_info.pixel_size[0]
         self.hr_dem_settings.high_res_dem_cfg.source_resolution = lr_dem_res
         self.hr_dem_settings.interpolator_cfg.source_resolution = lr_dem_res
-        self.hr_dem_gen = HighResDEMGen(self.lr_dem, self.hr_dem_settings)
+        self.build_hr_dem_gen()
 
     def load_lr_dem_by_path(self, path: str) -> None:
         """
@@ -167,7 +190,7 @@ class MapManager:
         lr_dem_res = self.lr_dem_info.pixel_size[0]
         self.hr_dem_settings.high_res_dem_cfg.source_resolution = lr_dem_res
         self.hr_dem_settings.interpolator_cfg.source_resolution = lr_dem_res
-        self.hr_dem_gen = HighResDEMGen(self.lr_dem, self.hr_dem_settings)
+        self.build_hr_dem_gen()
 
     def load_lr_dem_by_id(self, id: int) -> None:
         """
@@ -192,7 +215,7 @@ class MapManager:
         lr_dem_res = self.lr_dem_info.pixel_size[0]
         self.hr_dem_settings.high_res_dem_cfg.source_resolution = lr_dem_res
         self.hr_dem_settings.interpolator_cfg.source_resolution = lr_dem_res
-        self.hr_dem_gen = HighResDEMGen(self.lr_dem, self.hr_dem_settings)
+        self.build_hr_dem_gen()
 
     def generate_procedural_lr_dem(self):
         """
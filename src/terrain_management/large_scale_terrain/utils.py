@@ -6,16 +6,19 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
-from scipy.interpolate import CubicSpline
-from typing import Tuple
+from typing import List, Tuple
+import contextlib
 import dataclasses
+import numba as nb
 import numpy as np
 import threading
+import os
+import sys
 import time
 import zfpy
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class BoundingBox:
     x_min: float = 0
     x_max: float = 0
@@ -28,10 +31,47 @@ class BoundingBox:
 
 @dataclasses.dataclass
 class RockBlockData:
-    coordinates: np.ndarray = dataclasses.field(default_factory=np.ndarray)
-    quaternion: np.ndarray = dataclasses.field(default_factory=np.ndarray)
-    scale: np.ndarray = dataclasses.field(default_factory=np.ndarray)
-    ids: np.ndarray = dataclasses.field(default_factory=np.ndarray)
+    """
+    Rocks of a block, stored as one contiguous array per attribute.
+    The arrays are cast to their dtype when the block is created.
+
+    Args:
+        coordinates (np.ndarray): positions of the rocks. (N, 3) float32.
+        quaternion (np.ndarray): orientations of the rocks. (N, 4) float32.
+        scale (np.ndarray): scales of the rocks. (N, 3) float32.
+        ids (np.ndarray): ids of the rocks. (N,) int32.
+    """
+
+    __slots__ = ("coordinates", "quaternion", "scale", "ids")
+    coordinates: np.ndarray
+    quaternion: np.ndarray
+    scale: np.ndarray
+    ids: np.ndarray
+
+    def __post_init__(self) -> None:
+        self.coordinates = np.ascontiguousarray(self.coordinates, dtype=np.float32)
+        self.quaternion = np.ascontiguousarray(self.quaternion, dtype=np.float32)
+        self.scale = np.ascontiguousarray(self.scale, dtype=np.float32)
+        self.ids = np.ascontiguousarray(self.ids, dtype=np.int32)
+
+    @classmethod
+    def empty(cls, n: int) -> "RockBlockData":
+        """
+        Allocates a block of n rocks, the content of the arrays is not initialized.
+
+        Args:
+            n (int): number of rocks.
+
+        Returns:
+            RockBlockData: block of rocks.
+        """
+
+        return cls(
+            coordinates=np.empty((n, 3), dtype=np.float32, order="C"),
+            quaternion=np.empty((n, 4), dtype=np.float32, order="C"),
+            scale=np.empty((n, 3), dtype=np.float32, order="C"),
+            ids=np.empty((n,), dtype=np.int32, order="C"),
+        )
 
     def __sizeof__(self) -> int:
         return self.coordinates.nbytes + self.quaternion.nbytes + self.scale.nbytes + self.ids.nbytes
@@ -49,7 +89,7 @@ class RockBlockData:
         )
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class CompressedRockBlockData:
     coordinates: bytes = dataclasses.field(default_factory=bytes)
     quaternion: bytes = dataclasses.field(default_factory=bytes)
@@ -77,34 +117,478 @@ class CompressedRockBlockData:
         )
 
 
-# TODO (antoine.richard): Add a memory footprint method to the CraterMetadata class
+@dataclasses.dataclass(slots=True)
+class QuantizedSpline:
+    """
+    Uniform cubic B-spline, whose coefficients are stored as 16 bits fixed-point values.
+    The coefficients are obtained by prefiltering samples taken every dx, starting at x0,
+    see build_cubic_prefilter_batch, and quantized with quantize_profiles. The spline is
+    evaluated with eval_cubic.
+
+    Args:
+        coeffs (np.ndarray): quantized B-spline coefficients. (N,) int16.
+        scale (float): value of one quantization step.
+        x0 (float): position of the first sample.
+        dx (float): distance between two samples.
+    """
+
+    coeffs: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros(4, dtype=np.int16))
+    scale: float = 1.0
+    x0: float = 0.0
+    dx: float = 1.0
+
+
+def quantize_profiles(f: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes profiles to 16 bits fixed-point values. Each profile is scaled such that
+    its largest absolute value maps to 32767.
+
+    Args:
+        f (np.ndarray): profiles, one profile per row. (M, N)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: quantized profiles (M, N) int16, and value of one
+            quantization step for each profile (M,) float64.
+    """
+
+    scale = np.abs(f).max(axis=-1) / 32767.0
+    scale[scale == 0] = 1.0
+    q = np.rint(f / scale[..., None]).astype(np.int16)
+    return q, scale
+
+
+@nb.njit(fastmath=True, cache=True)
+def _prefilter_line(s: np.ndarray, c: np.ndarray) -> None:
+    """
+    Computes the coefficients of the cubic B-spline interpolating uniformly spaced
+    samples. The samples are filtered by a causal and an anticausal recursion, with
+    mirror boundaries.
+
+    Args:
+        s (np.ndarray): samples. (N,), N > 1.
+        c (np.ndarray): B-spline coefficients, written in place. (N,)
+    """
+
+    p = np.sqrt(3.0) - 2.0
+    n = s.shape[0]
+    zn = p ** (n - 1)
+    z2n = zn * zn
+    # Initial value of the causal recursion for a mirrored signal
+    acc = s[0] + zn * s[n - 1]
+    zi = p
+    zr = z2n / p
+    for i in range(1, n - 1):
+        acc += (zi + zr) * s[i]
+        zi *= p
+        zr /= p
+    c[0] = 6.0 * acc / (1.0 - z2n)
+    # Causal recursion
+    for i in range(1, n):
+        c[i] = 6.0 * s[i] + p * c[i - 1]
+    # Anticausal recursion
+    c[n - 1] = (p / (p * p - 1.0)) * (c[n - 1] + p * c[n - 2])
+    for i in range(n - 2, -1, -1):
+        c[i] = p * (c[i + 1] - c[i])
+
+
+@nb.njit(parallel=True, fastmath=True, cache=True)
+def build_cubic_prefilter_batch(samples: np.ndarray) -> np.ndarray:
+    """
+    Computes the coefficients of the cubic B-splines interpolating a batch of uniformly
+    sampled profiles. Each profile is filtered by a causal and an anticausal recursion,
+    with mirror boundaries. The profiles are filtered in parallel.
+
+    Args:
+        samples (np.ndarray): samples of the profiles, one profile per row. (M, N), N > 1.
+
+    Returns:
+        np.ndarray: B-spline coefficients of the profiles. (M, N) float32.
+    """
+
+    coeffs = np.empty(samples.shape, dtype=np.float32)
+    for k in nb.prange(samples.shape[0]):
+        _prefilter_line(samples[k], coeffs[k])
+    return coeffs
+
+
+def make_bicubic_wlut(n_sub: int = 256) -> np.ndarray:
+    """
+    Precomputes the weights of the 4-tap cubic B-spline kernel, and of its derivative,
+    for n_sub + 1 fractional offsets regularly spaced in [0, 1]. The weights only depend
+    on the fractional offset of the position between two samples, hence evaluating a
+    spline only requires looking them up.
+
+    Args:
+        n_sub (int): number of subdivisions between two samples.
+
+    Returns:
+        np.ndarray: weights (index 0) and derivative weights (index 1) of the kernel,
+            for each offset k / n_sub. (2, n_sub + 1, 4) float32.
+    """
+
+    f = np.arange(n_sub + 1, dtype=np.float64) / n_sub
+    f2 = f * f
+    f3 = f2 * f
+    wlut = np.empty((2, n_sub + 1, 4), dtype=np.float32)
+    wlut[0, :, 0] = (1.0 - 3.0 * f + 3.0 * f2 - f3) / 6.0
+    wlut[0, :, 1] = (4.0 - 6.0 * f2 + 3.0 * f3) / 6.0
+    wlut[0, :, 2] = (1.0 + 3.0 * f + 3.0 * f2 - 3.0 * f3) / 6.0
+    wlut[0, :, 3] = f3 / 6.0
+    wlut[1, :, 0] = -((1.0 - f) ** 2) / 2.0
+    wlut[1, :, 1] = (3.0 * f2 - 4.0 * f) / 2.0
+    wlut[1, :, 2] = (1.0 + 2.0 * f - 3.0 * f2) / 2.0
+    wlut[1, :, 3] = f2 / 2.0
+    return wlut
+
+
+@nb.njit(fastmath=True, cache=True)
+def eval_cubic(coeffs: np.ndarray, scale: float, x0: float, dx: float, x: np.ndarray, wlut: np.ndarray) -> np.ndarray:
+    """
+    Evaluates a uniform cubic B-spline using the 4-tap B-spline kernel. The weights
+    of the kernel are read from a lookup table, see make_bicubic_wlut. The positions
+    are clamped to the sampled interval, and the coefficients are mirrored at the
+    boundaries. The coefficients are quantized, they are only scaled back once the
+    weighted sum is computed.
+
+    Args:
+        coeffs (np.ndarray): quantized B-spline coefficients, see quantize_profiles. (N,) int16.
+        scale (float): value of one quantization step.
+        x0 (float): position of the first sample.
+        dx (float): distance between two samples.
+        x (np.ndarray): positions at which the spline is evaluated.
+        wlut (np.ndarray): weights of the kernel, see make_bicubic_wlut. (2, n_sub + 1, 4)
+
+    Returns:
+        np.ndarray: values of the spline, same shape as x. float32.
+    """
+
+    n = coeffs.shape[0]
+    last = n - 1
+    n_sub = wlut.shape[1] - 1
+    xf = x.ravel()
+    out = np.empty(xf.shape[0], dtype=np.float32)
+    for k in range(xf.shape[0]):
+        t = min(max((xf[k] - x0) / dx, 0.0), last)
+        i = min(int(t), last - 1)
+        r = int((t - i) * n_sub + 0.5)
+        im1 = 1 if i == 0 else i - 1
+        ip2 = 2 * last - i - 2 if i + 2 > last else i + 2
+        out[k] = scale * (
+            wlut[0, r, 0] * coeffs[im1]
+            + wlut[0, r, 1] * coeffs[i]
+            + wlut[0, r, 2] * coeffs[i + 1]
+            + wlut[0, r, 3] * coeffs[ip2]
+        )
+    return out.reshape(x.shape)
+
+
+@dataclasses.dataclass(slots=True)
+class PiecewiseCubic:
+    """
+    Piecewise cubic polynomial, stored as plain arrays. This holds the coefficients of a
+    scipy CubicSpline, without the Python object around them. It is evaluated with
+    eval_piecewise_cubic.
+
+    Args:
+        coeffs (np.ndarray): coefficients of each piece, highest degree first. (K, 4) float64.
+        breaks (np.ndarray): boundaries of the pieces, in ascending order. (K + 1,) float64.
+    """
+
+    coeffs: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((1, 4)))
+    breaks: np.ndarray = dataclasses.field(default_factory=lambda: np.array([0.0, 1.0]))
+
+    @classmethod
+    def from_cubic_spline(cls, spline) -> "PiecewiseCubic":
+        """
+        Extracts the coefficients of a scipy CubicSpline.
+
+        Args:
+            spline (CubicSpline): spline to convert.
+
+        Returns:
+            PiecewiseCubic: the piecewise cubic polynomial of the spline.
+        """
+
+        return cls(
+            coeffs=np.ascontiguousarray(spline.c.T, dtype=np.float64),
+            breaks=np.ascontiguousarray(spline.x, dtype=np.float64),
+        )
+
+
+@nb.njit(cache=True)
+def eval_piecewise_cubic(coeffs: np.ndarray, breaks: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    Evaluates a piecewise cubic polynomial. The piece of each position is first guessed
+    as if the breaks were uniformly spaced, then corrected, which only takes a couple of
+    comparisons when they are. Positions outside of the breaks are extrapolated from the
+    first or last piece. The pieces are found, and the polynomials are evaluated, the
+    same way scipy does, such that the values match the ones of the CubicSpline. The
+    values are computed in float64, and stored with the type of x.
+
+    Args:
+        coeffs (np.ndarray): coefficients of each piece, highest degree first. (K, 4) float64.
+        breaks (np.ndarray): boundaries of the pieces, in ascending order. (K + 1,) float64.
+        x (np.ndarray): positions at which the polynomial is evaluated.
+
+    Returns:
+        np.ndarray: values of the polynomial, same shape and type as x.
+    """
+
+    n = coeffs.shape[0]
+    x0 = breaks[0]
+    dx = (breaks[n] - x0) / n
+    xf = x.ravel()
+    out = np.empty(xf.shape[0], dtype=x.dtype)
+    for k in range(xf.shape[0]):
+        xv = xf[k]
+        if np.isnan(xv):
+            out[k] = np.nan
+            continue
+        i = int(min(max((xv - x0) / dx, 0.0), n - 1))
+        while (i > 0) and (xv < breaks[i]):
+            i -= 1
+        while (i < n - 1) and (xv >= breaks[i + 1]):
+            i += 1
+        s = xv - breaks[i]
+        z = s
+        v = coeffs[i, 3]
+        v = v + coeffs[i, 2] * z
+        z = z * s
+        v = v + coeffs[i, 1] * z
+        z = z * s
+        out[k] = v + coeffs[i, 0] * z
+    return out.reshape(x.shape)
+
+
+# Tolerance, in pixels, on the position of the rotated values before they are considered outside the array.
+_ROTATE_EDGE_EPS = 1e-6
+
+
+@nb.njit(nogil=True, fastmath=True, cache=True)
+def rotate_cubic(data: np.ndarray, angle: float, cval: float, wlut: np.ndarray) -> np.ndarray:
+    """
+    Rotates a 2D array around its center using cubic B-spline interpolation. The shape
+    of the array is kept, the values that come from outside the array are set to cval.
+    The B-spline coefficients of the array are computed by filtering its rows, then its
+    columns. Each output value is then a 4x4 weighted sum of the coefficients, whose
+    weights are read from a lookup table, see make_bicubic_wlut.
+
+    The function does not hold the GIL, and does not use Numba's thread pool, hence it
+    can be called from several threads, or from forked processes.
+
+    Args:
+        data (np.ndarray): array to rotate. (H, W), H > 1, W > 1.
+        angle (float): rotation angle. (degrees)
+        cval (float): value given to the points that are outside the array once rotated.
+        wlut (np.ndarray): weights of the kernel, see make_bicubic_wlut. (2, n_sub + 1, 4)
+
+    Returns:
+        np.ndarray: rotated array. (H, W) float32.
+    """
+
+    h, w = data.shape
+    # Computes the B-spline coefficients along the rows, then along the columns.
+    coeffs = np.empty((h, w), dtype=np.float32)
+    for i in range(h):
+        _prefilter_line(data[i], coeffs[i])
+    line = np.empty(h, dtype=np.float32)
+    column = np.empty(h, dtype=np.float32)
+    for j in range(w):
+        for i in range(h):
+            line[i] = coeffs[i, j]
+        _prefilter_line(line, column)
+        for i in range(h):
+            coeffs[i, j] = column[i]
+
+    a = np.deg2rad(angle)
+    cos = np.cos(a)
+    sin = np.sin(a)
+    cy = (h - 1) / 2.0
+    cx = (w - 1) / 2.0
+    n_sub = wlut.shape[1] - 1
+    out = np.empty((h, w), dtype=np.float32)
+    for i in range(h):
+        for j in range(w):
+            # Position of the output value in the input array
+            y = cos * (i - cy) + sin * (j - cx) + cy
+            x = -sin * (i - cy) + cos * (j - cx) + cx
+            # The positions that are within rounding errors of the edges are snapped onto them. Otherwise,
+            # the edges are lost when rotating by multiples of 90 degrees, where they land at -1e-15 or so.
+            if (y < -_ROTATE_EDGE_EPS) or (y > h - 1 + _ROTATE_EDGE_EPS):
+                out[i, j] = cval
+                continue
+            if (x < -_ROTATE_EDGE_EPS) or (x > w - 1 + _ROTATE_EDGE_EPS):
+                out[i, j] = cval
+                continue
+            y = min(max(y, 0.0), h - 1.0)
+            x = min(max(x, 0.0), w - 1.0)
+            py = min(int(y), h - 2)
+            px = min(int(x), w - 2)
+            ry = int((y - py) * n_sub + 0.5)
+            rx = int((x - px) * n_sub + 0.5)
+            acc = 0.0
+            for ky in range(4):
+                # Mirrors the taps that fall outside the array
+                yy = abs(py + ky - 1)
+                if yy > h - 1:
+                    yy = 2 * (h - 1) - yy
+                row = 0.0
+                for kx in range(4):
+                    xx = abs(px + kx - 1)
+                    if xx > w - 1:
+                        xx = 2 * (w - 1) - xx
+                    row += wlut[0, rx, kx] * coeffs[yy, xx]
+                acc += wlut[0, ry, ky] * row
+            out[i, j] = acc
+    return out
+
+
+@nb.njit(parallel=True, fastmath=True, cache=True)
+def minmax(arr: np.ndarray) -> Tuple[float, float]:
+    """
+    Computes the minimum and the maximum of a 2D array in a single pass.
+    The rows are reduced in parallel, then the partial results are combined.
+
+    Args:
+        arr (np.ndarray): array to reduce. (H, W), H > 0, W > 0.
+
+    Returns:
+        Tuple[float, float]: minimum and maximum of the array.
+    """
+
+    h, w = arr.shape
+    row_min = np.empty(h, dtype=arr.dtype)
+    row_max = np.empty(h, dtype=arr.dtype)
+    for i in nb.prange(h):
+        mn = arr[i, 0]
+        mx = arr[i, 0]
+        for j in range(1, w):
+            v = arr[i, j]
+            mn = min(mn, v)
+            mx = max(mx, v)
+        row_min[i] = mn
+        row_max[i] = mx
+    return row_min.min(), row_max.max()
+
+
 # TODO (antoine.richard): Find a way to compress a list of CraterMetadata objects.
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class CraterMetadata:
     radius: float = 0.0
     coordinates: Tuple[int, int] = (0, 0)
-    deformation_spline_id: CubicSpline = None
-    marks_spline_id: CubicSpline = None
+    deformation_spline_id: int = 0
+    marks_spline_id: int = 0
     marks_intensity: float = 0
     crater_profile_id: int = 0
     xy_deformation_factor: Tuple[float, float] = (0, 0)
     rotation: float = 0
 
     def get_memory_footprint(self) -> int:
-        return -1
+        """
+        Gets the memory footprint of the crater metadata, including its tuples.
+
+        Returns:
+            int: memory footprint of the crater metadata in bytes.
+        """
 
+        return sys.getsizeof(self) + sys.getsizeof(self.coordinates) + sys.getsizeof(self.xy_deformation_factor)
 
-class ScopedTimer:
+
+# Layout of the crater metadata when stored in numpy arrays, for instance to share them with
+# other processes. The fields follow the attributes of CraterMetadata, in the same order, such
+# that CraterMetadata(*record.tolist()) gives back the metadata of a crater. The coordinates are
+# kept in float64, as they are expressed in the frame of the whole map.
+CRATER_METADATA_DTYPE = np.dtype(
+    [
+        ("radius", np.float32),
+        ("coordinates", np.float64, (2,)),
+        ("deformation_spline_id", np.int32),
+        ("marks_spline_id", np.int32),
+        ("marks_intensity", np.float32),
+        ("crater_profile_id", np.int32),
+        ("xy_deformation_factor", np.float32, (2,)),
+        ("rotation", np.float32),
+    ]
+)
+
+
+def craters_to_records(craters: List[CraterMetadata]) -> np.ndarray:
+    """
+    Packs a list of crater metadata into a structured array.
+
+    Args:
+        craters (List[CraterMetadata]): list of crater metadata.
+
+    Returns:
+        np.ndarray: the crater metadata. (N,) CRATER_METADATA_DTYPE.
+    """
+
+    return np.array(
+        [
+            (
+                c.radius,
+                c.coordinates,
+                c.deformation_spline_id,
+                c.marks_spline_id,
+                c.marks_intensity,
+                c.crater_profile_id,
+                c.xy_deformation_factor,
+                c.rotation,
+            )
+            for c in craters
+        ],
+        dtype=CRATER_METADATA_DTYPE,
+    )
+
+
+def _write_stdout(chunks: List[bytes]) -> None:
+    """
+    Writes chunks of bytes to the standard output in a single system call when possible.
+    Whatever was buffered in sys.stdout is flushed first, such that the order of the
+    outputs is kept. If sys.stdout is not backed by a file descriptor, the chunks are
+    written to it instead.
+
+    Args:
+        chunks (List[bytes]): chunks to write, in order.
+    """
+
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, OSError, ValueError):
+        sys.stdout.write(b"".join(chunks).decode())
+        return
+    sys.stdout.flush()
+    written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+    remaining = b"".join(chunks)[written:]
+    while remaining:
+        remaining = remaining[os.write(fd, remaining) :]
+
+
+class _RealScopedTimer:
+    __slots__ = (
+        "name",
+        "argb_color",
+        "rgb_color",
+        "ansi_color",
+        "color_bytes",
+        "label_bytes",
+        "unit_bytes",
+        "indent",
+        "unit",
+        "unit_multiplier",
+        "start_time",
+        "end_time",
+    )
     _thread_local_data = threading.local()
 
-    def __init__(self, name, active=True, argb_color=None, unit="s"):
+    def __init__(self, name, argb_color=None, unit="s"):
         self.name = name
-        self.active = active
         self.argb_color = argb_color
         assert unit in ["s", "ms", "us"]
-        self.unit_multiplier = {"s": 1, "ms": 1e3, "us": 1e6}[unit]
+        # The time is measured in nanoseconds
+        self.unit_multiplier = {"s": 1e-9, "ms": 1e-6, "us": 1e-3}[unit]
         self.unit = unit
 
         if argb_color:
@@ -113,6 +597,10 @@ class ScopedTimer:
         else:
             self.ansi_color = ""
         self.indent = 2  # Number of spaces to indent per nesting level
+        # The constant parts of the message are encoded once, only the time is formatted on exit
+        self.color_bytes = self.ansi_color.encode()
+        self.label_bytes = f"{name} took: ".encode()
+        self.unit_bytes = f" {unit}\033[0m\n".encode()
 
     def argb_to_rgb(self, argb):
         rgb = (argb >> 16) & 0xFFFFFF
@@ -122,33 +610,64 @@ class ScopedTimer:
         return f"\033[38;2;{rgb[0]};{rgb[1]};{rgb[2]}m"
 
     def __enter__(self):
-        if self.active:
-            if not hasattr(self._thread_local_data, "nesting_level"):
-                self._thread_local_data.nesting_level = 0
-            if not hasattr(self._thread_local_data, "messages"):
-                self._thread_local_data.messages = []
+        if not hasattr(self._thread_local_data, "nesting_level"):
+            self._thread_local_data.nesting_level = 0
+        if not hasattr(self._thread_local_data, "messages"):
+            self._thread_local_data.messages = []
 
-            self._thread_local_data.nesting_level += 1
-            self.start_time = time.time()
+        self._thread_local_data.nesting_level += 1
+        self.start_time = time.perf_counter_ns()
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.active:
-            self.end_time = time.time()
-            elapsed_time = (self.end_time - self.start_time) * self.unit_multiplier
-            reset_color = "\033[0m"
-            indentation = " " * (self._thread_local_data.nesting_level - 1) * self.indent
-            message = f"{self.ansi_color}{indentation}{self.name} took: {elapsed_time:.4f} {self.unit}{reset_color}"
-
-            # Insert the message at the beginning of the list to ensure the outermost message is printed first
-            self._thread_local_data.messages.insert(0, message)
-
-            self._thread_local_data.nesting_level -= 1
-
-            # If we are back to the outermost level, print all accumulated messages
-            if self._thread_local_data.nesting_level == 0:
-                for msg in self._thread_local_data.messages:
-                    print(msg)
-                # Clear the message stack
-                self._thread_local_data.messages.clear()
+        self.end_time = time.perf_counter_ns()
+        elapsed_time = (self.end_time - self.start_time) * self.unit_multiplier
+
+        # The messages are appended as the timers exit, the outermost message comes last.
+        # They are only formatted once the outermost timer exits.
+        self._thread_local_data.messages.append((self._thread_local_data.nesting_level, self, elapsed_time))
+
+        self._thread_local_data.nesting_level -= 1
+
+        # If we are back to the outermost level, print all accumulated messages
+        if self._thread_local_data.nesting_level == 0:
+            # Print the messages in reverse to ensure the outermost message is printed first
+            chunks = [
+                timer.color_bytes
+                + b" " * ((level - 1) * timer.indent)
+                + timer.label_bytes
+                + b"%.4f" % elapsed
+                + timer.unit_bytes
+                for level, timer, elapsed in reversed(self._thread_local_data.messages)
+            ]
+            _write_stdout(chunks)
+            # Clear the message stack
+            self._thread_local_data.messages.clear()
+
+
+# Shared by all the inactive timers, entering and exiting it does nothing.
+_NULL_TIMER = contextlib.nullcontext()
+# Setting the OMNILRS_TIMERS environment variable to 0 disables all the timers, even the active ones.
+_TIMERS_ENABLED = os.environ.get("OMNILRS_TIMERS", "1") != "0"
+
+
+def ScopedTimer(name: str, active: bool = True, argb_color: int = None, unit: str = "s"):
+    """
+    Returns a timer that prints the time spent in a with block. Inactive timers are all
+    the same context manager, which does nothing. Hence, they are not constructed, and
+    cost close to nothing, even in tight loops.
+
+    Args:
+        name (str): name of the timer.
+        active (bool): whether the timer is active.
+        argb_color (int): color of the printed message, as an ARGB integer.
+        unit (str): unit of the printed time. Can be one of "s", "ms" or "us".
+
+    Returns:
+        the timer, to be used as a context manager.
+    """
+
+    if not (active and _TIMERS_ENABLED):
+        return _NULL_TIMER
+    return _RealScopedTimer(name, argb_color=argb_color, unit=unit)
@@ -6,7 +6,7 @@ __maintainer__ = "Antoine Richard"
 __email__ = "antoine.richard@uni.lu"
 __status__ = "development"
 
-from scipy.interpolate import CubicSpline
+from scipy.interpolate import CubicSpline, PPoly
 from matplotlib import pyplot as plt
 from scipy.ndimage import rotate
 from typing import List, Tuple
@@ -29,8 +29,8 @@ from src.terrain_management.deformation_engine import DeformationEngine
 
 @dataclasses.dataclass
 class CraterData:
-    deformation_spline: CubicSpline = None
-    marks_spline: CubicSpline = None
+    deformation_spline: PPoly = None
+    marks_spline: PPoly = None
     marks_intensity: float = 0
     size: int = 0
     crater_profile_id: int = 0
@@ -164,6 +164,26 @@ class CraterGenerator:
         crater = self._profiles[crater_data.crater_profile_id](2 * distance / crater_data.size)
         return crater
 
+    def buildSplines(self, profiles: np.ndarray) -> List[PPoly]:
+        """
+        Builds the splines of a batch of profiles sampled uniformly over [0, 1].
+        The splines have a zero slope at both ends. They are built as a single
+        vector valued spline, such that a single banded system is solved for
+        all of them.
+
+        Args:
+            profiles (np.ndarray): samples of the profiles, one profile per row.
+
+        Returns:
+            List[PPoly]: list of splines."""
+
+        x = np.linspace(0, 1, profiles.shape[1])
+        zeros = np.zeros(profiles.shape[0])
+        splines = CubicSpline(x, profiles, axis=1, bc_type=((1, zeros), (1, zeros)))
+        return [
+            PPoly.construct_fast(np.ascontiguousarray(splines.c[:, :, i]), splines.x) for i in range(profiles.shape[0])
+        ]
+
     def randomizeCraterParameters(self, index: int, size: int) -> CraterData:
         """
         Randomizes the parameters of a crater.
@@ -175,44 +195,67 @@ class CraterGenerator:
         Returns:
             CraterData: data regarding the crater generation."""
 
-        # Generates the metadata for a random crater
-        crater_data = CraterData()
-
-        # Makes sure the matrix size is odd
-        size = size + ((size % 2) == 0)
-        crater_data.size = size
-
-        # Generates a profile to deform the crater
-        deformation_profile = self._rng.uniform(0.95, 1, 9)
-        deformation_profile = np.concatenate([deformation_profile, [deformation_profile[0]]], axis=0)
-        tmp_x = np.linspace(0, 1, deformation_profile.shape[0])
-        crater_data.deformation_spline = CubicSpline(tmp_x, deformation_profile, bc_type=((1, 0.0), (1, 0.0)))
-
-        # Generates a profile to add marks that converges toward the center of the crater
-        marks_profile = self._rng.uniform(0.0, 0.01, 45)
-        marks_profile = np.concatenate([marks_profile, [marks_profile[0]]], axis=0)
-        tmp_x = np.linspace(0, 1, marks_profile.shape[0])
-        crater_data.marks_spline = CubicSpline(tmp_x, marks_profile, bc_type=((1, 0.0), (1, 0.0)))
-        crater_data.marks_intensity = self._rng.uniform(0, 1)
-
-        # XY deformation factor
-        sx = self._rng.uniform(self._min_xy_ratio, self._max_xy_ratio)
-        sy = 1.0
-        crater_data.xy_deformation_factor = (sx, sy)
-
-        # Random rotation
-        crater_data.rotation = int(self._rng.uniform(0, 360))
-
-        # Index of the profile
-        if index == -1:
-            index = self._rng.integers(0, len(self._profiles), 1)[0]
-            pass
-        elif index < len(self._profiles):
-            pass
-        else:
-            raise ValueError("Unknown profile")
-        crater_data.crater_profile_id = index
-        return crater_data
+        return self.randomizeCratersParameters(index, [size])[0]
+
+    def randomizeCratersParameters(self, index: int, sizes: List[int]) -> List[CraterData]:
+        """
+        Randomizes the parameters of several craters. The random values are drawn crater
+        after crater, then the splines of all the craters are built at once.
+
+        Args:
+            index (int): index of the profile to use.
+            sizes (List[int]): sizes of the craters.
+
+        Returns:
+            List[CraterData]: data regarding the generation of each crater."""
+
+        craters_data = []
+        deformation_profiles = []
+        marks_profiles = []
+        for size in sizes:
+            # Generates the metadata for a random crater
+            crater_data = CraterData()
+
+            # Makes sure the matrix size is odd
+            size = size + ((size % 2) == 0)
+            crater_data.size = size
+
+            # Generates a profile to deform the crater
+            deformation_profile = self._rng.uniform(0.95, 1, 9)
+            deformation_profiles.append(np.concatenate([deformation_profile, [deformation_profile[0]]], axis=0))
+
+            # Generates a profile to add marks that converges toward the center of the crater
+            marks_profile = self._rng.uniform(0.0, 0.01, 45)
+            marks_profiles.append(np.concatenate([marks_profile, [marks_profile[0]]], axis=0))
+            crater_data.marks_intensity = self._rng.uniform(0, 1)
+
+            # XY deformation factor
+            sx = self._rng.uniform(self._min_xy_ratio, self._max_xy_ratio)
+            sy = 1.0
+            crater_data.xy_deformation_factor = (sx, sy)
+
+            # Random rotation
+            crater_data.rotation = int(self._rng.uniform(0, 360))
+
+            # Index of the profile
+            crater_index = index
+            if crater_index == -1:
+                crater_index = self._rng.integers(0, len(self._profiles), 1)[0]
+                pass
+            elif crater_index < len(self._profiles):
+                pass
+            else:
+                raise ValueError("Unknown profile")
+            crater_data.crater_profile_id = crater_index
+            craters_data.append(crater_data)
+
+        if len(craters_data) > 0:
+            deformation_splines = self.buildSplines(np.stack(deformation_profiles))
+            marks_splines = self.buildSplines(np.stack(marks_profiles))
+            for crater_data, deformation_spline, marks_spline in zip(craters_data, deformation_splines, marks_splines):
+                crater_data.deformation_spline = deformation_spline
+                crater_data.marks_spline = marks_spline
+        return craters_data
 
     def generateCrater(
         self, size: int = None, index: int = -1, crater_data: CraterData = None
@@ -264,10 +307,12 @@ class CraterGenerator:
 
         # Adds the craters to the DEM
         if len(craters_data) == 0:
-            for coord, rad in zip(coords, radius):
-                rad = int(rad * 2 / self._resolution)
+            # Generating a crater does not draw random values, hence the parameters of all the
+            # craters can be drawn first, such that their splines are built in a single batch.
+            sizes = [int(rad * 2 / self._resolution) for rad in radius]
+            for coord, crater_data in zip(coords, self.randomizeCratersParameters(-1, sizes)):
                 coord_s = coord / self._resolution
-                c, crater_data = self.generateCrater(int(rad))
+                c, crater_data = self.generateCrater(crater_data=crater_data)
                 crater_data.coord = (coord[0], coord[1])
                 coord2 = (coord_s + self._pad_size).astype(np.int64)
                 coord = (coord_s - crater_data.size / 2 + self._pad_size).astype(np.int64)